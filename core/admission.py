@@ -0,0 +1,37 @@
+__all__ = ["Pool", "pools"]
+
+from collections.abc import Callable
+from typing import Any
+
+import anyio
+from fastapi import HTTPException
+
+from .config import AdmissionPool, config
+
+
+class Pool:
+    """
+    按代价分类的执行池，同时执行与排队的请求数量均有上限
+    排队已满时直接返回503，避免昂贵的请求占满线程，使廉价的请求一同排队超时
+    """
+
+    def __init__(self, name: str, data: AdmissionPool):
+        self.name: str = name
+        self.queue: int = data.queue
+        self.retry_after: int = data.retry_after
+        # 同时只有concurrency个请求占用线程，其余在此等待
+        self.limiter: anyio.CapacityLimiter = anyio.CapacityLimiter(data.concurrency)
+
+    @property
+    def full(self) -> bool:
+        statistics = self.limiter.statistics()
+        return statistics.borrowed_tokens >= statistics.total_tokens and statistics.tasks_waiting >= self.queue
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        """在池内的线程中执行，排队已满时拒绝"""
+        if self.full:
+            raise HTTPException(status_code=503, headers={"Retry-After": str(self.retry_after)})
+        return await anyio.to_thread.run_sync(func, *args, limiter=self.limiter)
+
+
+pools: dict[str, Pool] = {name: Pool(name, data) for name, data in config.admission.pools.items()}
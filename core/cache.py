@@ -0,0 +1,82 @@
+__all__ = ["CacheManager", "LRUCache", "sizeof"]
+
+import sys
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any
+
+
+def sizeof(obj: Any) -> int:
+    """对象及其包含的元素的内存占用"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, tuple | list | set | frozenset):
+        size += sum(sizeof(i) for i in obj)
+    elif isinstance(obj, dict):
+        size += sum(sizeof(k) + sizeof(v) for k, v in obj.items())
+    elif hasattr(obj, "__dict__"):
+        size += sizeof(vars(obj))
+    else:
+        # __slots__ 的属性不在 __dict__ 中
+        size += sum(
+            sizeof(getattr(obj, name))
+            for cls in type(obj).__mro__
+            for name in getattr(cls, "__slots__", ())
+            if hasattr(obj, name)
+        )
+    return size
+
+
+class LRUCache:
+    """按内存占用限制容量的LRU缓存，线程安全"""
+
+    def __init__(self, capacity: int):
+        # 容量，单位字节
+        self.capacity: int = capacity
+        self.size: int = 0
+        self.data: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self.lock: threading.Lock = threading.Lock()
+        CacheManager.add(self)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            if (item := self.data.get(key)) is None:
+                return default
+            self.data.move_to_end(key)
+            return item[0]
+
+    def set(self, key: Hashable, value: Any):
+        """已有的key重新计算占用，值在缓存后被修改时需再次设置"""
+        size = sizeof(key) + sizeof(value)
+        with self.lock:
+            if (item := self.data.pop(key, None)) is not None:
+                self.size -= item[1]
+            if size > self.capacity:
+                return
+            self.data[key] = (value, size)
+            self.size += size
+            while self.size > self.capacity:
+                _, (_, expired) = self.data.popitem(last=False)
+                self.size -= expired
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+class CacheManager:
+    caches: list[LRUCache] = []
+
+    @classmethod
+    def add(cls, cache: LRUCache):
+        cls.caches.append(cache)
+
+    @classmethod
+    def clear(cls):
+        """数据重新加载后清空所有缓存"""
+        for i in cls.caches:
+            i.clear()
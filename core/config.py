@@ -8,6 +8,8 @@ class Server:
         data = data or {}
         self.host: str = data.get("host", "127.0.0.1")
         self.port: int = data.get("port", 48910)
+        # 服务进程数，大于1时由主进程加载数据后fork工作进程
+        self.workers: int = data.get("workers", 1)
 
     @property
     def params(self):
@@ -15,21 +17,84 @@ class Server:
 
 
 class RateLimit:
-    def __init__(self, data: dict | None):
+    def __init__(self, name: str, data: dict | None):
         data = data or {}
+        self.name: str = name
         self.interval: float = data["interval"]
         self.query: int = data["query"]
 
     @property
     def param(self) -> dict:
-        return {"interval": self.interval, "query": self.query}
+        return {"name": self.name, "interval": self.interval, "query": self.query}
+
+
+class LimitBackend:
+    def __init__(self, data: dict | None):
+        data = data or {}
+        # memory / shared / redis，默认多进程时为shared
+        self.type: str | None = data.get("type")
+        # memory / shared：最多保存的key数量
+        self.slots: int = data.get("slots", 65536)
+        # redis：地址与key前缀
+        self.host: str = data.get("host", "127.0.0.1")
+        self.port: int = data.get("port", 6379)
+        # redis / shared：等待连接或跨进程锁的最长时间，超时时不限频
+        self.timeout: float = data.get("timeout", 0.05)
+        self.prefix: str = data.get("prefix", "limit")
 
 
 class Limit:
     def __init__(self, data: dict | None):
         data = data or {}
         self.timeout: float = data.get("timeout", 0.5)
-        self.rate: dict[str, RateLimit] = {k: RateLimit(v) for k, v in data.get("rate", {}).items()}
+        self.rate: dict[str, RateLimit] = {k: RateLimit(k, v) for k, v in data.get("rate", {}).items()}
+        # 补全请求开销很小，未配置时使用宽松的限频
+        self.rate.setdefault("story_suggest", RateLimit("story_suggest", {"interval": 1, "query": 20}))
+        self.backend: LimitBackend = LimitBackend(data.get("backend"))
+
+
+class Executor:
+    def __init__(self, data: dict | None):
+        data = data or {}
+        # 搜索子进程数，0为不启用
+        self.workers: int = data.get("workers", 0)
+        # 全文扫描的故事数达到该值才分片执行
+        self.threshold: int = data.get("threshold", 200)
+        # 提取摘要的故事数达到该值才分片执行
+        self.extra_threshold: int = data.get("extra_threshold", 20)
+
+
+class Cache:
+    def __init__(self, data: dict | None):
+        data = data or {}
+        # /story 搜索结果缓存容量，单位字节
+        self.story: int = data.get("story", 32 * 1024 * 1024)
+        # 摘要缓存容量，单位字节
+        self.extra: int = data.get("extra", 16 * 1024 * 1024)
+        # 记录的最近搜索数，新的搜索细化其中之一时在其结果中筛选
+        self.refine: int = data.get("refine", 64)
+
+
+class AdmissionPool:
+    def __init__(self, data: dict | None, concurrency: int, queue: int):
+        data = data or {}
+        # 同时执行的请求数
+        self.concurrency: int = data.get("concurrency", concurrency)
+        # 排队的请求数，超出时返回503
+        self.queue: int = data.get("queue", queue)
+        # 503响应的 Retry-After，单位秒
+        self.retry_after: int = data.get("retry_after", 1)
+
+
+class Admission:
+    def __init__(self, data: dict | None):
+        data = data or {}
+        self.pools: dict[str, AdmissionPool] = {
+            # 只查索引或读取原文
+            "light": AdmissionPool(data.get("light"), 16, 64),
+            # 需要扫描原文
+            "heavy": AdmissionPool(data.get("heavy"), 4, 8),
+        }
 
 
 class Config:
@@ -38,6 +103,9 @@ class Config:
         self.key: str = data.get("key", "")
         self.server: Server = Server(data.get("server"))
         self.limit: Limit = Limit(data.get("limit"))
+        self.executor: Executor = Executor(data.get("executor"))
+        self.cache: Cache = Cache(data.get("cache"))
+        self.admission: Admission = Admission(data.get("admission"))
 
 
 try:
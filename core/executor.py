@@ -0,0 +1,53 @@
+__all__ = ["ShardExecutor", "executor"]
+
+import gc
+import multiprocessing
+from collections.abc import Callable, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+
+from .config import config
+
+
+class ShardExecutor:
+    """
+    多进程分片执行器
+    在数据加载完成、服务启动前fork出子进程，子进程通过写时复制只读共享语料，任务只传递故事key
+    服务线程启动后fork可能使子进程继承被占用的锁，因此不在运行中重建；数据更新由主进程替换整个工作进程完成
+    """
+
+    def __init__(self, workers: int):
+        self.workers: int = workers
+        self.pool: ProcessPoolExecutor | None = None
+
+    def start(self):
+        if self.workers <= 0 or self.pool is not None:
+            return
+        # 冻结已加载的对象，避免子进程修改引用计数导致共享页面被复制
+        gc.freeze()
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+        # fork方式在首次提交时创建全部子进程，此时尚未启动服务线程
+        self.pool.submit(int).result()
+
+    def stop(self):
+        """服务结束后关闭子进程，避免工作进程退出后子进程遗留"""
+        if self.pool is None:
+            return
+        pool, self.pool = self.pool, None
+        pool.shutdown(cancel_futures=True)
+
+    def enabled(self, size: int, threshold: int) -> bool:
+        return self.pool is not None and size >= threshold
+
+    def map(self, func: Callable[..., Any], stories: Sequence, *args) -> list[Any]:
+        """
+        分片执行
+        :param func: func(shard, *args)，需可被pickle
+        :param stories: 按间隔均分给各子进程，平衡文本长度
+        :return: 各分片的结果
+        """
+        futures = [self.pool.submit(func, stories[i :: self.workers], *args) for i in range(self.workers)]
+        return [f.result() for f in futures]
+
+
+executor = ShardExecutor(config.executor.workers)
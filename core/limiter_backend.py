@@ -0,0 +1,337 @@
+"""
+限频计数的存储后端
+
+memory：进程内，单进程部署
+shared：匿名共享内存中的定长计数表，由fork出的工作进程共享；等待跨进程锁超时时不限频
+redis：Redis协议的网络后端，多机部署共享；测试时可用 LocalClient 代替
+均使用滑动窗口计数：上一窗口的计数按未过去的比例计入，每个key的状态大小固定
+时间取自单调时钟，不受系统时间调整影响
+"""
+
+__all__ = ["Backend", "LocalClient", "MemoryBackend", "RedisBackend", "RedisClient", "SharedBackend", "create_backend"]
+
+import hashlib
+import math
+import mmap
+import multiprocessing
+import socket
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Hashable, Iterator
+from typing import Any
+
+from .config import LimitBackend, config
+
+
+def slide(
+    start: float, current: int, previous: int, now: float, interval: float, query: int
+) -> tuple[float, int, int, bool]:
+    """
+    滑动窗口计数
+    :param start: 当前窗口的开始时间
+    :param current: 当前窗口的计数
+    :param previous: 上一窗口的计数
+    :return: (start, current, previous, 是否允许)，允许时计数已加一
+    """
+    if now - start >= interval:
+        previous = current if now - start < 2 * interval else 0
+        current = 0
+        start = now - (now - start) % interval
+    if previous * (1 - (now - start) / interval) + current >= query:
+        return start, current, previous, False
+    return start, current + 1, previous, True
+
+
+class Backend(ABC):
+    @abstractmethod
+    def apply(self, name: str, key: Hashable, interval: float, query: int) -> bool:
+        """记录一次请求，超出限制时返回False"""
+
+    def clean(self):  # noqa: B027
+        """清理过期的key，由定时任务调用；计数随窗口过期的后端无需实现"""
+
+
+class TimingWheel:
+    """
+    按过期时间分桶的时间轮，每次推进只处理经过的桶
+    过期时间超出一圈的key会提前被取出，由调用方检查后重新加入
+    """
+
+    def __init__(self, tick: float, size: int):
+        self.tick: float = tick
+        self.buckets: list[set[Hashable]] = [set() for _ in range(size)]
+        # 下一个待处理的刻度
+        self.current: int = int(time.monotonic() // tick)
+        # 此前的桶均为空，淘汰时从这里开始查找
+        self.first: int = self.current
+
+    def slot(self, expire: float) -> int:
+        # 已经过去的刻度放入下一个待处理的桶
+        return max(int(expire // self.tick), self.current)
+
+    def add(self, key: Hashable, expire: float):
+        tick = self.slot(expire)
+        self.buckets[tick % len(self.buckets)].add(key)
+        self.first = min(self.first, tick)
+
+    def advance(self, now: float) -> Iterator[Hashable]:
+        """取出到now为止经过的桶中的key"""
+        end = int(now // self.tick)
+        # 超过一圈时每个桶只需处理一次
+        start = max(self.current, end - len(self.buckets) + 1)
+        self.current = end + 1
+        for tick in range(start, end + 1):
+            i = tick % len(self.buckets)
+            bucket, self.buckets[i] = self.buckets[i], set()
+            yield from bucket
+
+    def nearest(self) -> Hashable | None:
+        """最早到期的桶中的任意key，取出后 first 为该桶的刻度"""
+        size = len(self.buckets)
+        for tick in range(max(self.first, self.current), self.current + size):
+            if bucket := self.buckets[tick % size]:
+                self.first = tick
+                return bucket.pop()
+        return None
+
+
+class MemoryBackend(Backend):
+    """
+    进程内计数，每个key保存 (窗口开始时间, 当前窗口计数, 上一窗口计数, 过期时间)
+    过期由时间轮逐步清理；key数量达到上限时淘汰最早到期的key，内存不随不同IP的数量增长
+    """
+
+    def __init__(self, capacity: int, tick: float = 1, size: int = 64):
+        self.capacity: int = capacity
+        self.data: dict[tuple[str, Hashable], tuple[float, int, int, float]] = {}
+        self.wheel: TimingWheel = TimingWheel(tick, size)
+        self.lock: threading.Lock = threading.Lock()
+
+    def apply(self, name: str, key: Hashable, interval: float, query: int) -> bool:
+        now = time.monotonic()
+        item = (name, key)
+        with self.lock:
+            if (state := self.data.get(item)) is None:
+                self.evict()
+                self.wheel.add(item, now + 2 * interval)
+                start, current, previous = now, 0, 0
+            else:
+                start, current, previous, _ = state
+            start, current, previous, allowed = slide(start, current, previous, now, interval, query)
+            self.data[item] = (start, current, previous, start + 2 * interval)
+        return allowed
+
+    def evict(self):
+        """
+        key数量达到上限时淘汰最早到期的key
+        key按首次请求时的过期时间加入时间轮，之后的请求会延后过期时间，取出时按当前的过期时间重新加入，避免淘汰仍在计数的key
+        """
+        moved = set()
+        while len(self.data) >= self.capacity and (victim := self.wheel.nearest()) is not None:
+            if (state := self.data.get(victim)) is None:
+                continue
+            # 过期时间超出一圈的key每次都会提前取出，重新加入过一次的不再加入
+            if victim not in moved and self.wheel.slot(state[3]) > self.wheel.first:
+                moved.add(victim)
+                self.wheel.add(victim, state[3])
+                continue
+            del self.data[victim]
+
+    def clean(self):
+        now = time.monotonic()
+        with self.lock:
+            for item in self.wheel.advance(now):
+                if (state := self.data.get(item)) is None:
+                    continue
+                if state[3] <= now:
+                    del self.data[item]
+                else:
+                    # 期间有新的请求，按新的过期时间重新加入
+                    self.wheel.add(item, state[3])
+
+
+class SharedBackend(Backend):
+    """
+    开放寻址的定长计数表，需在fork工作进程前创建
+    槽位：key摘要 | 窗口开始时间 | 过期时间 | 当前窗口计数 | 上一窗口计数
+    探测范围内没有空闲或过期的槽位时，替换最早过期的槽位
+    """
+
+    slot = struct.Struct("<QddII")
+    # 线性探测的最大次数
+    probes = 8
+
+    def __init__(self, slots: int, timeout: float = 0.05):
+        self.slots: int = slots
+        # 等待锁的最长时间；持有锁的工作进程被强制结束时锁不会释放
+        self.timeout: float = timeout
+        # 匿名映射为 MAP_SHARED，fork后各进程读写同一块内存
+        self.buffer: mmap.mmap = mmap.mmap(-1, slots * self.slot.size)
+        self.lock = multiprocessing.get_context("fork").Lock()
+
+    @staticmethod
+    def digest(name: str, key: Hashable) -> int:
+        # 内置hash在不同进程中不一致；0表示空槽位
+        return int.from_bytes(hashlib.blake2b(f"{name}\0{key}".encode(), digest_size=8).digest(), "little") or 1
+
+    def apply(self, name: str, key: Hashable, interval: float, query: int) -> bool:
+        digest = self.digest(name, key)
+        now = time.monotonic()
+        if not self.lock.acquire(timeout=self.timeout):
+            # 与Redis不可用时相同，不限频，避免所有工作进程一直等待
+            return True
+        try:
+            offset, start, current, previous = self.find(digest, now)
+            start, current, previous, allowed = slide(start, current, previous, now, interval, query)
+            self.slot.pack_into(self.buffer, offset, digest, start, start + 2 * interval, current, previous)
+        finally:
+            self.lock.release()
+        return allowed
+
+    def find(self, digest: int, now: float) -> tuple[int, float, int, int]:
+        """key所在的槽位，不存在时分配新槽位"""
+        size = self.slot.size
+        free = None
+        oldest, oldest_expire = None, math.inf
+        for i in range(self.probes):
+            offset = (digest + i) % self.slots * size
+            value, start, expire, current, previous = self.slot.unpack_from(self.buffer, offset)
+            if value == digest:
+                return offset, start, current, previous
+            if free is None and (value == 0 or expire <= now):
+                free = offset
+            if expire < oldest_expire:
+                oldest, oldest_expire = offset, expire
+        return (oldest if free is None else free), now, 0, 0
+
+
+class RedisClient:
+    """最小的RESP客户端，每个线程一个连接"""
+
+    def __init__(self, host: str, port: int, timeout: float):
+        self.address: tuple[str, int] = (host, port)
+        self.timeout: float = timeout
+        self.local = threading.local()
+
+    def connect(self):
+        if getattr(self.local, "file", None) is None:
+            conn = socket.create_connection(self.address, self.timeout)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.local.conn = conn
+            self.local.file = conn.makefile("rb")
+        return self.local.conn, self.local.file
+
+    def close(self):
+        if getattr(self.local, "file", None) is not None:
+            self.local.file.close()
+            self.local.conn.close()
+            self.local.file = None
+
+    def call(self, *args: Any) -> Any:
+        conn, file = self.connect()
+        command = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            arg = str(arg).encode()
+            command.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        try:
+            conn.sendall(b"".join(command))
+            return self.read(file)
+        except OSError:
+            self.close()
+            raise
+
+    def read(self, file) -> Any:
+        line = file.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        kind, data = line[:1], line[1:-2]
+        if kind == b"+":
+            return data.decode()
+        if kind == b"-":
+            raise RedisError(data.decode())
+        if kind == b":":
+            return int(data)
+        if kind == b"$":
+            return None if data == b"-1" else file.read(int(data) + 2)[:-2].decode()
+        if kind == b"*":
+            return None if data == b"-1" else [self.read(file) for _ in range(int(data))]
+        raise ConnectionError(f"unexpected reply {line!r}")
+
+    def eval(self, script: str, keys: list[str], args: list[Any]) -> Any:
+        sha = hashlib.sha1(script.encode()).hexdigest()
+        try:
+            return self.call("EVALSHA", sha, len(keys), *keys, *args)
+        except RedisError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+            return self.call("EVAL", script, len(keys), *keys, *args)
+
+
+class RedisError(Exception):
+    pass
+
+
+class LocalClient:
+    """进程内代替Redis，按与脚本相同的算法计数"""
+
+    def __init__(self):
+        self.data: dict[str, tuple[float, int, int]] = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    def eval(self, script: str, keys: list[str], args: list[Any]) -> Any:
+        interval, query = float(args[0]), int(args[1])
+        now = time.monotonic()
+        with self.lock:
+            start, current, previous = self.data.get(keys[0], (now, 0, 0))
+            start, current, previous, allowed = slide(start, current, previous, now, interval, query)
+            self.data[keys[0]] = (start, current, previous)
+        return int(allowed)
+
+
+class RedisBackend(Backend):
+    """计数与时间均在Redis中由脚本原子完成，key随窗口过期"""
+
+    script = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local interval, query = tonumber(ARGV[1]), tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'start', 'current', 'previous')
+local start = tonumber(state[1]) or now
+local current = tonumber(state[2]) or 0
+local previous = tonumber(state[3]) or 0
+if now - start >= interval then
+    if now - start < 2 * interval then previous = current else previous = 0 end
+    current = 0
+    start = now - (now - start) % interval
+end
+if previous * (1 - (now - start) / interval) + current >= query then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'start', start, 'current', current + 1, 'previous', previous)
+redis.call('PEXPIRE', KEYS[1], math.ceil(interval * 2000))
+return 1
+"""
+
+    def __init__(self, client: RedisClient | LocalClient, prefix: str = "limit"):
+        self.client: RedisClient | LocalClient = client
+        self.prefix: str = prefix
+
+    def apply(self, name: str, key: Hashable, interval: float, query: int) -> bool:
+        try:
+            return self.client.eval(self.script, [f"{self.prefix}:{name}:{key}"], [interval, query]) == 1
+        except (OSError, RedisError):
+            # 后端不可用时不限频，避免影响正常请求
+            return True
+
+
+def create_backend(data: LimitBackend) -> Backend:
+    kind = data.type
+    if kind is None:
+        kind = "shared" if config.server.workers > 1 else "memory"
+    if kind == "shared":
+        return SharedBackend(data.slots, data.timeout)
+    if kind == "redis":
+        return RedisBackend(RedisClient(data.host, data.port, data.timeout), data.prefix)
+    return MemoryBackend(data.slots)
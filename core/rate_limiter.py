@@ -1,33 +1,31 @@
 import asyncio
-from collections import deque
 from collections.abc import Callable, Hashable
 
 from fastapi import Depends, HTTPException, Request
 
-from .util import Date
+from .config import config
+from .limiter_backend import Backend, create_backend
 
 
 class Limiter:
-    def __init__(self, interval: float, query: int, key: Callable[[Request], Hashable] | None = None):
+    def __init__(
+        self,
+        name: str,
+        interval: float,
+        query: int,
+        key: Callable[[Request], Hashable] | None = None,
+        backend: Backend | None = None,
+    ):
+        # 不同进程中同名的限频共享计数
+        self.name: str = name
         self.interval: float = interval
         self.query: int = query
-        self.queue_dict: dict[Hashable, deque] = {}
         self.key: Callable[[Request], Hashable] = key or self.default_key
-
-    def clean(self):
-        for k, queue in self.queue_dict.copy().items():
-            if Date.now - queue[-1] > self.interval:
-                self.queue_dict.pop(k)
+        self.backend: Backend = backend or LimiterManager.backend
+        LimiterManager.add(self)
 
     def apply(self, key: Hashable) -> bool:
-        queue = self.queue_dict.setdefault(key, deque(maxlen=self.query))
-        if len(queue) == self.query:
-            if Date.now - queue[0] < self.interval:
-                return False
-            queue.popleft()
-
-        queue.append(Date.now)
-        return True
+        return self.backend.apply(self.name, key, self.interval, self.query)
 
     @staticmethod
     def default_key(request: Request) -> str:
@@ -38,20 +36,23 @@ class Limiter:
             raise HTTPException(status_code=429)
 
     @classmethod
-    def depends(cls, interval: float, query: int):
+    def depends(cls, name: str, interval: float, query: int):
         self = cls.__new__(cls)
-        self.__init__(interval, query)
+        self.__init__(name, interval, query)
         return Depends(self.check)
 
 
 class LimiterManager:
     limiters: list[Limiter] = []
-    cd: int = 60
+    # 时间轮的刻度，每次只清理到期的key
+    cd: int = 1
+    # 在fork工作进程前创建，共享内存后端由此在进程间共享
+    backend: Backend = create_backend(config.limit.backend)
 
     @classmethod
     def clean(cls):
-        for i in cls.limiters:
-            i.clean()
+        for backend in {i.backend for i in cls.limiters}:
+            backend.clean()
 
     @classmethod
     async def scavenger(cls):
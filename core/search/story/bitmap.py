@@ -0,0 +1,37 @@
+"""
+以 int 作为位图的倒排表，第i位表示故事id为i
+交并集即整数的 & |，由CPython在机器字上批量完成
+"""
+
+__all__ = ["count", "from_ids", "iter_ids", "to_ids"]
+
+from collections.abc import Iterable, Iterator
+
+
+def from_ids(ids: Iterable[int]) -> int:
+    buffer = bytearray()
+    for i in ids:
+        byte = i >> 3
+        if byte >= len(buffer):
+            buffer.extend(bytes(byte - len(buffer) + 1))
+        buffer[byte] |= 1 << (i & 7)
+    return int.from_bytes(buffer, "little")
+
+
+def to_ids(bitmap: int) -> list[int]:
+    """升序的故事id"""
+    return list(iter_ids(bitmap))
+
+
+def iter_ids(bitmap: int) -> Iterator[int]:
+    """按升序逐个给出故事id，只需要前几个时不必展开全部"""
+    # 反转后第i个字符即第i位
+    bits = bin(bitmap)[:1:-1]
+    i = bits.find("1")
+    while i != -1:
+        yield i
+        i = bits.find("1", i + 1)
+
+
+def count(bitmap: int) -> int:
+    return bitmap.bit_count()
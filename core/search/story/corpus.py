@@ -0,0 +1,363 @@
+"""
+二进制语料文件，启动时通过 mmap 映射而非解析json
+
+文件结构：魔数 | 头部偏移 | 头部长度 | 按8字节对齐的数据段 ... | json头部
+文本以UTF-8保存，访问时才解码；行表、n-gram与词元倒排表直接以数组视图读取，词元的词表保存在头部
+"""
+
+__all__ = ["Corpus"]
+
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections.abc import Iterator, Mapping, Sequence
+from pathlib import Path
+
+import simdjson
+
+from .index import LineTable, NgramIndex, TokenIndex
+
+MAGIC = b"ASCORPUS"
+VERSION = 3
+# 魔数 + 头部偏移 + 头部长度
+PREFIX = struct.Struct("<8sQQ")
+ALIGN = 8
+# gram中每个字符占用的位数，n-gram编码为单个u64
+CHAR_BITS = 21
+
+
+def encode_gram(gram: str) -> int:
+    key = 0
+    for c in gram:
+        key = key << CHAR_BITS | ord(c)
+    return key
+
+
+def fingerprint(sources: list[str]) -> list[list[int]]:
+    """源文件的大小与修改时间，任一变化时重新生成"""
+    return [[(stat := Path(i).stat()).st_size, stat.st_mtime_ns] for i in sources]
+
+
+class TextTable(Mapping[str, str]):
+    """故事 -> 文本，访问时从映射中解码"""
+
+    def __init__(self, keys: list[str], blob: memoryview, offsets: Sequence[int]):
+        self.positions: dict[str, int] = {k: i for i, k in enumerate(keys)}
+        self.blob: memoryview = blob
+        self.offsets: Sequence[int] = offsets
+
+    def __getitem__(self, key: str) -> str:
+        i = self.positions[key]
+        return str(self.blob[self.offsets[i] : self.offsets[i + 1]], "utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.positions)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+
+class LineTableMap(Mapping[str, LineTable]):
+    """故事 -> 行首位置表，直接引用映射中的数组"""
+
+    def __init__(
+        self,
+        keys: list[str],
+        lengths: Sequence[int],
+        starts: Sequence[int],
+        speakers: Sequence[int],
+        offsets: Sequence[int],
+    ):
+        self.positions: dict[str, int] = {k: i for i, k in enumerate(keys)}
+        self.lengths: Sequence[int] = lengths
+        self.starts: Sequence[int] = starts
+        self.speakers: Sequence[int] = speakers
+        self.offsets: Sequence[int] = offsets
+
+    def __getitem__(self, key: str) -> LineTable:
+        i = self.positions[key]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return LineTable.mapped(self.lengths[i], self.starts[start:end], self.speakers[start:end])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.positions)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+
+class MappedNgramIndex(NgramIndex):
+    """gram按编码排序存储，查找时二分"""
+
+    def __init__(
+        self,
+        n: int,
+        keys: Sequence[int],
+        offsets: Sequence[int],
+        positions: Sequence[int],
+        stories: Sequence[int],
+        starts: Sequence[int],
+    ):
+        self.n = n
+        self.stories = stories
+        self.starts = starts
+        self.index = {}
+        self.keys: Sequence[int] = keys
+        self.offsets: Sequence[int] = offsets
+        self.positions: Sequence[int] = positions
+
+    def postings(self, gram: str) -> Sequence[int] | None:
+        key = encode_gram(gram)
+        i = bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        return self.positions[self.offsets[i] : self.offsets[i + 1]]
+
+
+class MappedTokenIndex(TokenIndex):
+    """单字与二字按编码排序存储，查找时二分"""
+
+    def __init__(
+        self,
+        vocab: list[str],
+        tokens: Sequence[int],
+        positions: Sequence[int],
+        offsets: Sequence[int],
+        postings: Sequence[int],
+        stories: Sequence[int],
+        starts: Sequence[int],
+        suffixes: Sequence[int],
+        gram_keys: Sequence[int],
+        gram_offsets: Sequence[int],
+        gram_ids: Sequence[int],
+    ):
+        self.vocab = vocab
+        self.tokens = tokens
+        self.positions = positions
+        self.offsets = offsets
+        self.postings = postings
+        self.stories = stories
+        self.starts = starts
+        self.suffixes = suffixes
+        self.grams = {}
+        self.gram_keys: Sequence[int] = gram_keys
+        self.gram_offsets: Sequence[int] = gram_offsets
+        self.gram_ids: Sequence[int] = gram_ids
+
+    def with_gram(self, gram: str) -> Sequence[int]:
+        key = encode_gram(gram)
+        i = bisect_left(self.gram_keys, key)
+        if i == len(self.gram_keys) or self.gram_keys[i] != key:
+            return ()
+        return self.gram_ids[self.gram_offsets[i] : self.gram_offsets[i + 1]]
+
+
+class Writer:
+    def __init__(self, path: Path):
+        self.file = path.open("wb")
+        self.offset = PREFIX.size
+        self.sections: dict[str, list] = {}
+        self.file.write(bytes(PREFIX.size))
+
+    def add(self, name: str, data: array | bytes):
+        typecode = data.typecode if isinstance(data, array) else "B"
+        data = memoryview(data).cast("B")
+        self.sections[name] = [self.offset, len(data), typecode]
+        padding = -len(data) % ALIGN
+        self.file.write(data)
+        self.file.write(bytes(padding))
+        self.offset += len(data) + padding
+
+    def close(self, header: dict):
+        header["sections"] = self.sections
+        data = simdjson.dumps(header, ensure_ascii=False).encode()
+        self.file.write(data)
+        self.file.seek(0)
+        self.file.write(PREFIX.pack(MAGIC, self.offset, len(data)))
+        self.file.close()
+
+
+class Corpus:
+    """
+    搜索所需的文本与索引
+    :param texts: 语言 -> 故事 -> 文本
+    :param lines: 语言 -> 故事 -> 行首位置表
+    :param ngrams: 语言 -> n-gram索引，仅不以空格分词的语言
+    :param tokens: 语言 -> 词元索引，仅以空格分词的语言
+    :param indexes: 索引名 -> 键 -> 故事位图
+    """
+
+    def __init__(
+        self,
+        texts: dict[str, Mapping[str, str]],
+        lines: dict[str, Mapping[str, LineTable]],
+        ngrams: dict[str, NgramIndex],
+        tokens: dict[str, TokenIndex],
+        indexes: dict[str, dict[str, int]],
+    ):
+        self.texts = texts
+        self.lines = lines
+        self.ngrams = ngrams
+        self.tokens = tokens
+        self.indexes = indexes
+
+    def dump(self, path: Path, sources: list[str]):
+        """写入临时文件后替换，避免其他进程读到不完整的文件"""
+        temp = path.with_suffix(".tmp")
+        writer = Writer(temp)
+        header = {
+            "version": VERSION,
+            "byteorder": sys.byteorder,
+            "sources": fingerprint(sources),
+            "langs": {},
+            "ngrams": {},
+            "tokens": {},
+            "indexes": {},
+        }
+
+        for lang, texts in self.texts.items():
+            header["langs"][lang] = list(texts)
+            offsets, lengths, line_offsets = array("Q", [0]), array("I"), array("Q", [0])
+            starts, speakers = array("I"), array("i")
+            blob = bytearray()
+            for key, text in texts.items():
+                blob += text.encode()
+                offsets.append(len(blob))
+                lengths.append(len(text))
+                lines = self.lines[lang][key]
+                starts.extend(lines.starts)
+                speakers.extend(lines.speakers)
+                line_offsets.append(len(starts))
+            writer.add(f"text/{lang}", blob)
+            writer.add(f"text_offsets/{lang}", offsets)
+            writer.add(f"text_lengths/{lang}", lengths)
+            writer.add(f"line_starts/{lang}", starts)
+            writer.add(f"line_speakers/{lang}", speakers)
+            writer.add(f"line_offsets/{lang}", line_offsets)
+
+        for lang, ngram in self.ngrams.items():
+            # 单个u64最多容纳3个字符
+            assert ngram.n * CHAR_BITS <= 64
+            grams = sorted(ngram.index, key=encode_gram)
+            offsets, positions = array("Q", [0]), array("I")
+            for gram in grams:
+                positions.extend(ngram.index[gram])
+                offsets.append(len(positions))
+            header["ngrams"][lang] = ngram.n
+            writer.add(f"ngram_keys/{lang}", array("Q", map(encode_gram, grams)))
+            writer.add(f"ngram_offsets/{lang}", offsets)
+            writer.add(f"ngram_positions/{lang}", positions)
+            writer.add(f"ngram_stories/{lang}", array("I", ngram.stories))
+            writer.add(f"ngram_starts/{lang}", array("I", ngram.starts))
+
+        for lang, index in self.tokens.items():
+            grams = sorted(index.grams, key=encode_gram)
+            gram_offsets, gram_ids = array("Q", [0]), array("I")
+            for gram in grams:
+                gram_ids.extend(index.grams[gram])
+                gram_offsets.append(len(gram_ids))
+            header["tokens"][lang] = list(index.vocab)
+            writer.add(f"token_ids/{lang}", array("I", index.tokens))
+            writer.add(f"token_positions/{lang}", array("I", index.positions))
+            writer.add(f"token_offsets/{lang}", array("Q", index.offsets))
+            writer.add(f"token_postings/{lang}", array("I", index.postings))
+            writer.add(f"token_stories/{lang}", array("I", index.stories))
+            writer.add(f"token_starts/{lang}", array("I", index.starts))
+            writer.add(f"token_suffixes/{lang}", array("I", index.suffixes))
+            writer.add(f"token_gram_keys/{lang}", array("Q", map(encode_gram, grams)))
+            writer.add(f"token_gram_offsets/{lang}", gram_offsets)
+            writer.add(f"token_gram_ids/{lang}", gram_ids)
+
+        for name, index in self.indexes.items():
+            header["indexes"][name] = list(index)
+            offsets = array("Q", [0])
+            blob = bytearray()
+            for stories in index.values():
+                blob += stories.to_bytes((stories.bit_length() + 7) // 8, "little")
+                offsets.append(len(blob))
+            writer.add(f"index/{name}", blob)
+            writer.add(f"index_offsets/{name}", offsets)
+
+        writer.close(header)
+        temp.replace(path)
+
+    @classmethod
+    def open(cls, path: Path, sources: list[str]) -> "Corpus | None":
+        """
+        映射语料文件
+        :param path: 语料文件
+        :param sources: 生成语料所用的源文件
+        :return: 文件不存在、格式不符或已过期时返回None
+        """
+        if not path.is_file() or path.stat().st_size < PREFIX.size:
+            return None
+        with path.open("rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, offset, length = PREFIX.unpack_from(buffer)
+        if magic != MAGIC:
+            return None
+        header = simdjson.loads(buffer[offset : offset + length])
+        if (
+            header["version"] != VERSION
+            or header["byteorder"] != sys.byteorder
+            or header["sources"] != fingerprint(sources)
+        ):
+            return None
+
+        view = memoryview(buffer)
+        sections = header["sections"]
+
+        def section(name: str) -> memoryview:
+            start, size, typecode = sections[name]
+            return view[start : start + size].cast(typecode)
+
+        texts, lines = {}, {}
+        for lang, keys in header["langs"].items():
+            texts[lang] = TextTable(keys, section(f"text/{lang}"), section(f"text_offsets/{lang}"))
+            lines[lang] = LineTableMap(
+                keys,
+                section(f"text_lengths/{lang}"),
+                section(f"line_starts/{lang}"),
+                section(f"line_speakers/{lang}"),
+                section(f"line_offsets/{lang}"),
+            )
+
+        ngrams = {
+            lang: MappedNgramIndex(
+                n,
+                section(f"ngram_keys/{lang}"),
+                section(f"ngram_offsets/{lang}"),
+                section(f"ngram_positions/{lang}"),
+                section(f"ngram_stories/{lang}"),
+                section(f"ngram_starts/{lang}"),
+            )
+            for lang, n in header["ngrams"].items()
+        }
+        tokens = {
+            lang: MappedTokenIndex(
+                vocab,
+                section(f"token_ids/{lang}"),
+                section(f"token_positions/{lang}"),
+                section(f"token_offsets/{lang}"),
+                section(f"token_postings/{lang}"),
+                section(f"token_stories/{lang}"),
+                section(f"token_starts/{lang}"),
+                section(f"token_suffixes/{lang}"),
+                section(f"token_gram_keys/{lang}"),
+                section(f"token_gram_offsets/{lang}"),
+                section(f"token_gram_ids/{lang}"),
+            )
+            for lang, vocab in header["tokens"].items()
+        }
+
+        # 位图需要转为int参与运算，体积较小，直接载入
+        indexes = {}
+        for name, keys in header["indexes"].items():
+            blob, offsets = section(f"index/{name}"), section(f"index_offsets/{name}")
+            indexes[name] = {
+                key: int.from_bytes(blob[offsets[i] : offsets[i + 1]], "little") for i, key in enumerate(keys)
+            }
+
+        return cls(texts, lines, ngrams, tokens, indexes)
@@ -1,23 +1,39 @@
 __all__ = [
-    "story_data",
-    "text_data",
-    "zone_name",
-    "text_index",
-    "char_id2story",
-    "char_name2story",
-    "zone_index",
-    "char_id2name",
-    "char_name2id",
-    "story_id2story_seq",
-    "multiple_memory",
+    "Snapshot",
+    "StaleSnapshotError",
+    "StoryData",
+    "get_snapshot",
+    "reload",
+    "snapshot_of",
 ]
 
+import itertools
+import threading
+from functools import reduce
+from operator import or_
 from pathlib import Path
-from typing import Any, TypedDict
+from typing import TYPE_CHECKING, Any, TypedDict
 
-from core.constant import data_path, support_language
+from core.cache import CacheManager
+from core.constant import data_path, default_lang, support_language
 from core.util import json
 
+from . import bitmap
+from .corpus import Corpus
+from .index import (
+    GramTextIndex,
+    LineTable,
+    NgramIndex,
+    PrefixIndex,
+    TextIndex,
+    TokenIndex,
+    WordTextIndex,
+    char_index,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+
 
 class StoryData:
     id: str
@@ -99,67 +115,210 @@ def get_path(filename: str) -> str:
     return str(Path(data_path) / "story" / (filename + ".json"))
 
 
-def to_set(data: dict) -> dict[Any, set[Any]]:
+def to_bitmap(data: dict, ids: dict[str, int]) -> dict[Any, int]:
     for k in data:
-        data[k] = set(data[k])
+        data[k] = bitmap.from_ids(ids[i] for i in data[k])
     return data
 
 
-story_data: dict[str, StoryData] = {k: StoryData(v) for k, v in json.load(get_path("story_data")).items()}
-text_data: dict[str, dict[str, str]] = json.load(get_path("text_data"))
-zone_name: dict[str, dict[support_language, str]] = json.load(get_path("zone_name"))
-text_index: dict[str, set[str]] = to_set(json.load(get_path("text_index")))
-char_id2story: dict[str, set[str]] = to_set(json.load(get_path("char_id2story")))
-char_name2story: dict[str, set[str]] = to_set(json.load(get_path("char_name2story")))
-zone_index: dict[str, set[str]] = to_set(json.load(get_path("zone_index")))
-seq_data: list[SeqData] = [SeqData(id=set(i[0]), name=set(i[1])) for i in json.load(get_path("seq_data"))]
-char_id2seq: dict[str, set[int]] = {}
-char_name2seq: dict[str, set[int]] = {}
-story_id2story_seq: dict[str, str] = {}
-multiple_memory: set[str] = set()
-
-
-def init_seq_data():
-    for i, data in enumerate(seq_data):
-        for char_id in data["id"]:
-            if char_id in char_name2seq:
-                char_id2seq[char_id].add(i)
-            else:
-                char_id2seq[char_id] = {i}
-        for char_name in data["name"]:
-            if char_name in char_name2seq:
-                char_name2seq[char_name].add(i)
+# 语料文件及生成它所用的源文件
+corpus_path = Path(data_path) / "story" / "corpus.bin"
+corpus_sources = ["story_data", "text_data", "text_index", "char_id2story", "char_name2story", "zone_index"]
+# 以空格分词的语言使用词索引，其余语言使用n-gram索引
+word_languages = {"en_US"}
+
+
+def char_index_name(lang: str) -> str:
+    # 默认语言的单字索引由数据给出
+    return "text_index" if lang == default_lang else f"text_index/{lang}"
+
+
+def load_corpus(ids: dict[str, int]) -> Corpus:
+    sources = [get_path(i) for i in corpus_sources]
+    if (corpus := Corpus.open(corpus_path, sources)) is not None:
+        return corpus
+
+    # 由json生成语料并写入文件，之后的启动直接映射
+    texts = json.load(get_path("text_data"))
+    indexes = {name: to_bitmap(json.load(get_path(name)), ids) for name in corpus_sources[2:]}
+    for lang, data in texts.items():
+        if lang in word_languages:
+            indexes[f"word_index/{lang}"] = WordTextIndex.build(data, ids)
+        elif lang != default_lang:
+            indexes[char_index_name(lang)] = char_index(data, ids)
+    corpus = Corpus(
+        texts=texts,
+        lines={lang: {k: LineTable(text) for k, text in data.items()} for lang, data in texts.items()},
+        ngrams={lang: NgramIndex(data, ids) for lang, data in texts.items() if lang not in word_languages},
+        tokens={lang: TokenIndex(data, ids) for lang, data in texts.items() if lang in word_languages},
+        indexes=indexes,
+    )
+    try:
+        corpus.dump(corpus_path, sources)
+    except OSError:
+        # 数据目录不可写时使用内存中的数据
+        return corpus
+    return Corpus.open(corpus_path, sources) or corpus
+
+
+class Snapshot:
+    """
+    某一时刻加载的全部剧情数据，加载后不再修改
+    数据更新时整体替换，请求开始时取得快照并在整个处理过程中使用
+    """
+
+    def __init__(self, version: int):
+        self.version: int = version
+        self.story_data: dict[str, StoryData] = {k: StoryData(v) for k, v in json.load(get_path("story_data")).items()}
+        # 故事id按key排序分配，位图按id升序遍历即为排序后的结果
+        self.story_keys: list[str] = sorted(self.story_data)
+        self.story_ids: dict[str, int] = {k: i for i, k in enumerate(self.story_keys)}
+        corpus = load_corpus(self.story_ids)
+        self.text_data: dict[str, Mapping[str, str]] = corpus.texts
+        # 语言 -> 故事 -> 行首位置表
+        self.line_data: dict[str, Mapping[str, LineTable]] = corpus.lines
+        self.zone_name: dict[str, dict[support_language, str]] = json.load(get_path("zone_name"))
+        # 语言 -> 文本索引
+        self.text_indexes: dict[str, TextIndex] = {}
+        self.char_id2story: dict[str, int] = corpus.indexes["char_id2story"]
+        self.char_name2story: dict[str, int] = corpus.indexes["char_name2story"]
+        self.zone_index: dict[str, int] = corpus.indexes["zone_index"]
+        self.seq_data: list[SeqData] = [SeqData(id=set(i[0]), name=set(i[1])) for i in json.load(get_path("seq_data"))]
+        self.char_id2seq: dict[str, set[int]] = {}
+        self.char_name2seq: dict[str, set[int]] = {}
+        # 角色名 -> 全部别名
+        self.char_aliases: dict[str, frozenset[str]] = {}
+        # 角色名 -> 出现的故事位图，合并该名称及其对应的各角色id的故事
+        self.char_stories: dict[str, int] = {}
+        self.story_id2story_seq: dict[str, str] = {}
+        self.multiple_memory: set[str] = set()
+        # 语言 -> 故事 -> 返回的各字段，顺序与 StoryRequire 的位一致
+        self.story_rows: dict[str, dict[str, tuple]] = {}
+        # 语言 -> 角色名与该语言的区域名 -> (参数类型, 参数, 名称)，按出现的故事数排序
+        self.suggestions: dict[str, PrefixIndex] = {}
+
+        self.init_text_indexes(corpus)
+        self.init_seq_data()
+        self.init_char_alias()
+        self.init_story_id2story_seq_data()
+        self.init_multiple_memory_data()
+        self.init_story_rows()
+        self.init_suggestions()
+
+    def init_text_indexes(self, corpus: Corpus):
+        for lang, texts in self.text_data.items():
+            stories = bitmap.from_ids(self.story_ids[k] for k in texts)
+            if lang in word_languages:
+                self.text_indexes[lang] = WordTextIndex(
+                    corpus.tokens[lang], corpus.indexes[f"word_index/{lang}"], stories
+                )
             else:
-                char_name2seq[char_name] = {i}
-
-
-init_seq_data()
-
-
-def init_story_id2story_seq_data():
-    for s, data in story_data.items():
-        story_id2story_seq[data.id] = s
-
-
-init_story_id2story_seq_data()
-
-
-def init_multiple_memory_data():
-    for data in story_data.values():
-        if data.type == "Memory" and data.id.split("_")[-1] != "1":
-            multiple_memory.add("_".join(data.id.split("_")[:-1] + ["1"]))
-
-
-init_multiple_memory_data()
-
-
-def char_id2name(char_id: str) -> set[str]:
-    result = set()
-    result = result.union(*(seq_data[seq]["name"] for seq in char_id2seq[char_id]))
-    return result
-
-
-def char_name2id(char_name: str) -> set[str]:
-    result = set()
-    result = result.union(*(seq_data[seq]["id"] for seq in char_name2seq[char_name]))
-    return result
+                self.text_indexes[lang] = GramTextIndex(
+                    corpus.ngrams[lang], corpus.indexes[char_index_name(lang)], stories
+                )
+
+    def init_seq_data(self):
+        for i, data in enumerate(self.seq_data):
+            for char_id in data["id"]:
+                if char_id in self.char_id2seq:
+                    self.char_id2seq[char_id].add(i)
+                else:
+                    self.char_id2seq[char_id] = {i}
+            for char_name in data["name"]:
+                if char_name in self.char_name2seq:
+                    self.char_name2seq[char_name].add(i)
+                else:
+                    self.char_name2seq[char_name] = {i}
+
+    def init_char_alias(self):
+        """按 名称 -> 角色id -> 名称 展开别名，并合并各角色id的故事，查询时只需一次字典查找"""
+        for char_name, seqs in self.char_name2seq.items():
+            char_ids = set().union(*(self.seq_data[i]["id"] for i in seqs))
+            self.char_aliases[char_name] = frozenset().union(
+                *(self.seq_data[i]["name"] for char_id in char_ids for i in self.char_id2seq[char_id])
+            )
+            self.char_stories[char_name] = reduce(
+                or_, (self.char_id2story.get(i, 0) for i in char_ids), self.char_name2story.get(char_name, 0)
+            )
+        for char_name, stories in self.char_name2story.items():
+            self.char_stories.setdefault(char_name, stories)
+
+    def init_story_id2story_seq_data(self):
+        for s, data in self.story_data.items():
+            self.story_id2story_seq[data.id] = s
+
+    def init_multiple_memory_data(self):
+        for data in self.story_data.values():
+            if data.type == "Memory" and data.id.split("_")[-1] != "1":
+                self.multiple_memory.add("_".join(data.id.split("_")[:-1] + ["1"]))
+
+    def init_story_rows(self):
+        for lang in support_language.__args__:
+            self.story_rows[lang] = {
+                k: (
+                    data.id,
+                    data.type,
+                    data.name.get(lang),
+                    data.code,
+                    data.long_name.get(lang),
+                    data.short_name.get(lang),
+                    data.zone,
+                    self.zone_name.get(data.zone, {}).get(lang),
+                )
+                for k, data in self.story_data.items()
+            }
+
+    def init_suggestions(self):
+        """角色名的搜索与语言无关，各语言都包含全部角色名；区域名只包含该语言的名称"""
+        chars = [
+            (name, bitmap.count(stories), ("char", name, name))
+            for name, stories in self.char_stories.items()
+            if stories
+        ]
+        for lang in support_language.__args__:
+            zones = (
+                (names[lang], bitmap.count(stories), ("zone", zone, names[lang]))
+                for zone, names in self.zone_name.items()
+                if lang in names and (stories := self.zone_index.get(zone, 0))
+            )
+            self.suggestions[lang] = PrefixIndex(itertools.chain(chars, zones))
+
+    def char_alias(self, char_name: str) -> frozenset[str]:
+        """未收录别名的名称只对应其本身"""
+        return self.char_aliases.get(char_name) or frozenset((char_name,))
+
+
+class StaleSnapshotError(Exception):
+    """子进程持有的快照与请求的快照不一致"""
+
+
+snapshot: Snapshot = Snapshot(0)
+reload_lock = threading.Lock()
+
+
+def get_snapshot() -> Snapshot:
+    return snapshot
+
+
+def snapshot_of(version: int) -> Snapshot:
+    """子进程中取得与请求一致的快照，重新fork前提交的任务可能遇到新的快照"""
+    if snapshot.version != version:
+        raise StaleSnapshotError
+    return snapshot
+
+
+def reload() -> bool:
+    """
+    在当前线程加载新的快照并替换，进行中的请求继续使用旧快照
+    启用搜索子进程时由多进程主进程调用，fork出的新工作进程再创建子进程
+    :return: 已有加载在进行时返回False
+    """
+    global snapshot
+    if not reload_lock.acquire(blocking=False):
+        return False
+    try:
+        snapshot = Snapshot(snapshot.version + 1)
+        CacheManager.clear()
+    finally:
+        reload_lock.release()
+    return True
@@ -1,14 +1,27 @@
-__all__ = ["Extra", "ExtraData"]
+__all__ = ["Extra", "ExtraData", "ExtraRow"]
 
 import re
 from collections.abc import Callable
-from typing import Literal
+from functools import cached_property, lru_cache
+from itertools import islice
+from typing import Any, Literal
 
 from pydantic import BaseModel
 
-from .data import char_id2name, char_name2id, text_data
+from core.cache import LRUCache
+from core.config import config
+from core.constant import default_lang, support_language
+from core.executor import executor
+from core.util import Deadline, unlimited
+
+from .data import Snapshot, StaleSnapshotError, snapshot_of
+from .index import LineTable
+from .regex_safety import LinearMatch, compile_safe, finditer
 from .search import StorySearchParam, StorySearchParamGroup
 
+# 处理器直接给出可序列化的dict，不经过模型校验；模型描述其结构，用于接口文档
+ExtraRow = dict[str, Any]
+
 
 class TextData(BaseModel):
     type: Literal["text"] = "text"
@@ -17,12 +30,14 @@ class TextData(BaseModel):
     raw: str
 
     @classmethod
-    def get_handler(cls, param: StorySearchParam) -> Callable[[str], "TextData"]:
+    def get_handler(
+        cls, param: StorySearchParam, data: Snapshot, deadline: Deadline = unlimited
+    ) -> Callable[[str, LineTable], ExtraRow]:
         target = param.param
         # 结果组
         base_result = [target if i == 2 else "" for i in range(5)]
 
-        def handler(text: str) -> TextData:
+        def handler(text: str, lines: LineTable) -> ExtraRow:
             result_group = []
             # 已处理的文本index
             forward_index = 0
@@ -38,64 +53,51 @@ class TextData(BaseModel):
 
                 # copy基础结果
                 result = base_result.copy()
+                # 目标所在行 & 目标结尾所在行
+                line = lines.line_of(target_index)
+                end_line = lines.line_of(target_forward_index)
 
-                # result[3] & check 寻找最近的下一个换行符
-                n2_index = text.find("\n", target_forward_index)
-                if n2_index == -1:
-                    # 文本末尾
-                    result[3] = text[target_forward_index:]
-                else:
-                    result[3] = text[target_forward_index:n2_index]
-
-                if result[3].find(": ") != -1:
+                # result[3] & check
+                result[3] = text[target_forward_index : lines.end(end_line)]
+                if not lines.is_dialogue(target_forward_index):
                     # 排除角色名
-                    forward_index = n2_index
+                    forward_index = lines.end(end_line)
                     continue
 
                 # result[1]
-                n1_index = text.rfind("\n", 0, target_index)
-                if n1_index == -1:
-                    result[1] = text[:target_index]
-                else:
-                    result[1] = text[n1_index + 1 : target_index]
+                result[1] = text[lines.start(line) : target_index]
 
                 # result[0]
-                if n1_index != -1:
-                    n0_index = text.rfind("\n", 0, n1_index)
-                    if n0_index >= added_index:
-                        if n0_index == -1:
-                            result[0] = text[:n1_index]
-                        else:
-                            result[0] = text[n0_index + 1 : n1_index]
+                if line > 0 and lines.start(line - 1) > added_index:
+                    result[0] = text[lines.start(line - 1) : lines.end(line - 1)]
 
                 # result[4]
-                if n2_index != -1:
-                    n2_index += 1
-                    n3_index = text.find("\n", n2_index)
-                    if n3_index == -1:
-                        result[4] = text[n2_index:]
-                    else:
-                        result[4] = text[n2_index:n3_index]
+                if end_line + 1 < len(lines):
+                    next_line = end_line + 1
+                    result[4] = text[lines.start(next_line) : lines.end(next_line)]
 
                     if result[4].find(target) > result[4].find(": "):
-                        added_index = n2_index
+                        added_index = lines.start(next_line)
                         # 排除下一行有target
                         result[4] = ""
                     else:
-                        added_index = n3_index
+                        added_index = lines.end(next_line)
 
                 forward_index = target_forward_index
                 result_group.append(result)
 
-            self = cls.__new__(cls)
             # TODO has_more优化判断
-            self.__init__(data=result_group, raw=target, has_more=len(result_group) > 4)
-
-            return self
+            return {"type": "text", "data": result_group, "has_more": len(result_group) > 4, "raw": target}
 
         return handler
 
 
+@lru_cache(maxsize=1024)
+def speaker_pattern(names: frozenset[str]) -> re.Pattern:
+    """以任一名称开头的台词行，按名称集合缓存"""
+    return re.compile(rf"^(?:{'|'.join(re.escape(i) for i in sorted(names))}):.*", flags=re.MULTILINE)
+
+
 class CharData(BaseModel):
     type: Literal["char"] = "char"
     data: list[str]
@@ -103,28 +105,24 @@ class CharData(BaseModel):
     raw: str
 
     @classmethod
-    def get_handler(cls, param: StorySearchParam) -> Callable[[str], "CharData"]:
-        char_possible_names = set()
+    def get_handler(
+        cls, param: StorySearchParam, data: Snapshot, deadline: Deadline = unlimited
+    ) -> Callable[[str, LineTable], ExtraRow]:
         # 该角色名对应的所有可能的名称
-        [[char_possible_names.add(name) for name in char_id2name(char_id)] for char_id in char_name2id(param.param)]
-        regex = re.compile(rf"^(?:{'|'.join(re.escape(i) for i in char_possible_names)}):.*", flags=re.MULTILINE)
+        regex = speaker_pattern(data.char_alias(param.param))
 
         # TODO 真路人npc名称查找问题
 
-        def handler(text: str) -> CharData:
+        def handler(text: str, lines: LineTable) -> ExtraRow:
             """
             CharData handler
             :param text:故事文本
+            :param lines:行首位置表
             :return: CharData
             """
-            res = regex.findall(text)
-            self = cls.__new__(cls)
-            if len(res) > 5:
-                self.__init__(data=res[:5], has_more=True, raw=param.param)
-            else:
-                self.__init__(data=res, has_more=False, raw=param.param)
-
-            return self
+            # 多取一行用于判断has_more，无需找出全部台词
+            res = [i.group() for i in islice(regex.finditer(text), 6)]
+            return {"type": "char", "data": res[:5], "has_more": len(res) > 5, "raw": param.param}
 
         return handler
 
@@ -136,20 +134,38 @@ class RegexData(BaseModel):
     raw: str
 
     @classmethod
-    def get_handler(cls, param: StorySearchParam) -> Callable[[str], "RegexData"]:
-        # TODO 弃用纯正则，优化效率
-
-        regex = re.compile(rf"(?:(.+)\n)?^(.*)({param.param})(.*)$(?:\n(.+))", flags=re.MULTILINE)
-
-        def handler(text: str) -> RegexData:
-            res = regex.findall(text)
-            self = cls.__new__(cls)
-            if len(res) > 5:
-                self.__init__(data=[self.format_res(i) for i in res[:5]], has_more=True, raw=param.param)
-            else:
-                self.__init__(data=[self.format_res(i) for i in res], has_more=False, raw=param.param)
-
-            return self
+    def get_handler(
+        cls, param: StorySearchParam, data: Snapshot, deadline: Deadline = unlimited
+    ) -> Callable[[str, LineTable], ExtraRow]:
+        regex = compile_safe(param.param, flags=re.MULTILINE)
+
+        def handler(text: str, lines: LineTable) -> ExtraRow:
+            # 行 -> 该行最后一个命中，多取一行用于判断has_more
+            matched: dict[int, re.Match | LinearMatch] = {}
+            for match in finditer(regex, text, deadline):
+                line = lines.line_of(match.start())
+                if line not in matched and len(matched) > 5:
+                    break
+                matched[line] = match
+
+            result = []
+            # 已展示的最后一行
+            shown = -1
+            for line in list(matched)[:5]:
+                match = matched[line]
+                end_line = lines.line_of(match.end())
+                group = ["", text[lines.start(line) : match.start()], match.group(), "", ""]
+                group[3] = text[match.end() : lines.end(end_line)]
+                if line > 0 and line - 1 > shown:
+                    group[0] = text[lines.start(line - 1) : lines.end(line - 1)]
+                # 下一行同样命中时由其自身展示
+                shown = end_line
+                if end_line + 1 < len(lines) and end_line + 1 not in matched:
+                    shown = end_line + 1
+                    group[4] = text[lines.start(shown) : lines.end(shown)]
+                result.append(cls.format_res(group))
+
+            return {"type": "regex", "data": result, "has_more": len(matched) > 5, "raw": param.param}
 
         return handler
 
@@ -167,20 +183,75 @@ class RegexData(BaseModel):
 ExtraData = TextData | CharData | RegexData
 
 
+# (快照版本, 语言, 故事, 参数类型, 参数) -> 摘要
+extra_cache = LRUCache(config.cache.extra)
+
+
 class Extra:
-    """提取数据，提供快速搜索"""
+    """提取数据，提供快速搜索；每个请求只构建一次处理器，结果按故事与参数缓存"""
 
-    handler_dict: dict[str, Callable[[StorySearchParam], Callable[[str], ExtraData]]] = {
+    handler_dict: dict[str, Callable[[StorySearchParam, Snapshot, Deadline], Callable[[str, LineTable], ExtraRow]]] = {
         "text": TextData.get_handler,
         "char": CharData.get_handler,
         "regex": RegexData.get_handler,
     }
 
-    def __init__(self, params: StorySearchParamGroup):
-        self.params: StorySearchParamGroup = params
-        self.handlers = [self.handler_dict[i.type](i) for i in params if i.type in self.handler_dict]
-
-    def get(self, story_id: str) -> list[ExtraData]:
-        text = text_data["zh_CN"][story_id]
-        match = [handler(text) for handler in self.handlers]
+    def __init__(
+        self,
+        params: StorySearchParamGroup,
+        data: Snapshot,
+        lang: support_language = default_lang,
+        deadline: Deadline = unlimited,
+    ):
+        self.params: StorySearchParamGroup = [i for i in params if i.type in self.handler_dict]
+        self.data: Snapshot = data
+        self.lang: support_language = lang
+        self.deadline: Deadline = deadline
+        self.keys: list[tuple[str, str]] = [(i.type, i.param) for i in self.params]
+
+    @cached_property
+    def handlers(self) -> list[Callable[[str, LineTable], ExtraRow]]:
+        # 全部命中缓存时无需构建
+        return [self.handler_dict[i.type](i, self.data, self.deadline) for i in self.params]
+
+    def get(self, story_id: str) -> list[ExtraRow]:
+        self.deadline.check()
+        text = self.data.text_data[self.lang][story_id]
+        lines = self.data.line_data[self.lang][story_id]
+        match = [handler(text, lines) for handler in self.handlers]
         return match
+
+    def get_many(self, stories: list[str]) -> dict[str, list[ExtraRow]]:
+        result = {}
+        missing = []
+        for story in stories:
+            cached = [extra_cache.get((self.data.version, self.lang, story, *key)) for key in self.keys]
+            if None in cached:
+                missing.append(story)
+            else:
+                result[story] = cached
+
+        computed = None
+        if self.params and executor.enabled(len(missing), config.executor.extra_threshold):
+            computed = {}
+            try:
+                for shard in executor.map(extract, missing, self.data.version, self.params, self.lang, self.deadline):
+                    computed.update(shard)
+            except StaleSnapshotError:
+                # 子进程已更换为新的快照，在本进程中完成
+                computed = None
+        if computed is None:
+            computed = {story: self.get(story) for story in missing}
+
+        for story, match in computed.items():
+            for key, data in zip(self.keys, match, strict=True):
+                extra_cache.set((self.data.version, self.lang, story, *key), data)
+        result.update(computed)
+        return result
+
+
+def extract(
+    stories: list[str], version: int, params: StorySearchParamGroup, lang: support_language, deadline: Deadline
+) -> dict[str, list[ExtraRow]]:
+    extra = Extra(params, snapshot_of(version), lang, deadline)
+    return {story: extra.get(story) for story in stories}
@@ -1,17 +1,29 @@
+import heapq
+from collections import deque
 from enum import IntEnum
-from typing import Annotated, Any
+from functools import cache
+from itertools import islice
+from typing import Annotated, Any, Literal
 
-from fastapi import HTTPException, Query
+import orjson
+from fastapi import Depends, HTTPException, Query
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel, Field
 
+from core.admission import pools
+from core.cache import LRUCache
 from core.config import config
 from core.constant import support_language
 from core.rate_limiter import Limiter
-from core.server import app
+from core.server import app, get_deadline
+from core.single_flight import SingleFlight
+from core.util import Deadline
 
-from .data import multiple_memory, story_data, story_id2story_seq, text_data, zone_name
-from .extra import Extra, ExtraData
-from .search import StorySearchParamGroup, search
+from . import bitmap
+from .data import Snapshot, get_snapshot, reload
+from .extra import Extra, ExtraData, ExtraRow
+from .regex_safety import RegexBudgetError
+from .search import StorySearchParamGroup, relevance, scan_cheaper, search
 
 
 class StoryRequire(IntEnum):
@@ -53,66 +65,193 @@ class StoryRequest(BaseModel):
     limit: int = Query(ge=1, le=100, default=20)
     offset: int = Query(ge=0, default=0)
     require: int = StoryRequire.PC
+    # id：按故事id；relevance：按文本参数的出现次数从多到少，相同时按故事id
+    order: Literal["id", "relevance"] = "id"
+
+    def cost(self, data: Snapshot) -> str:
+        """正则需要扫描原文，索引无法给出位置或位置过多的文本需要在候选故事中逐个定位"""
+        index = data.text_indexes[self.lang]
+        for p in self.params:
+            if p.type == "regex" or (
+                p.type == "text" and (not index.positional(p.param) or scan_cheaper(index, p.param, index.stories))
+            ):
+                return "heavy"
+        return "light"
+
+
+class SearchResult:
+    """缓存的搜索结果，相关度得分在首次按相关度排序时计算，之后的翻页直接使用"""
+
+    __slots__ = ("scores", "stories")
+
+    def __init__(self, stories: int):
+        self.stories = stories
+        self.scores: dict[int, int] | None = None
+
+
+# (快照版本, 参数, 语言) -> 搜索结果，排序与分页在取出时进行
+story_cache = LRUCache(config.cache.story)
+# 最近完成的搜索的缓存key，用于逐字输入时在上一次的结果中筛选
+recent_searches: deque[tuple] = deque(maxlen=config.cache.refine)
+# 合并同时到达的相同搜索与相同请求
+search_flight = SingleFlight()
+story_flight = SingleFlight()
+
+
+def cache_key(data: Snapshot, params: StorySearchParamGroup, lang: support_language) -> tuple:
+    """参数之间为交集关系，与顺序、重复无关"""
+    return data.version, tuple(sorted({(p.type, p.param) for p in params})), lang
+
+
+def request_key(data: Snapshot, req: StoryRequest) -> tuple:
+    """摘要按参数顺序生成，需保留原始顺序"""
+    return (
+        data.version,
+        tuple((p.type, p.param) for p in req.params),
+        req.lang,
+        req.limit,
+        req.offset,
+        req.require,
+        req.order,
+    )
+
+
+def refines(params: tuple, base: tuple) -> bool:
+    """
+    params 的结果是否必定包含于 base 的结果，即 base 的每个参数在 params 中都有相同或更严格的参数
+    文本参数延长后仍包含原文本即更严格；含 ":" 的文本可能跨过角色名分界，较短的文本在同一位置反而属于角色名，不作判断
+    空文本被任何文本包含，但其结果与其他文本无关，不作为细化的依据
+    """
+    return all(
+        any(p == b or (p[0] == b[0] == "text" and b[1] and b[1] in p[1] and ":" not in p[1]) for p in params)
+        for b in base
+    )
+
+
+def refine_base(key: tuple) -> int | None:
+    """最近的搜索中被当前搜索细化、且结果仍在缓存中的最小结果"""
+    version, params, lang = key
+    best = None
+    # 复制后遍历，避免其他线程同时添加
+    for base in list(recent_searches):
+        if base[0] != version or base[2] != lang or not refines(params, base[1]):
+            continue
+        if (result := story_cache.get(base)) is not None and (
+            best is None or result.stories.bit_count() < best.bit_count()
+        ):
+            best = result.stories
+    return best
+
+
+def search_stories(
+    data: Snapshot, params: StorySearchParamGroup, lang: support_language, deadline: Deadline, scored: bool = False
+) -> SearchResult:
+    """
+    :param scored: 是否需要相关度得分，每个缓存key只计算一次
+    """
+    key = cache_key(data, params, lang)
+    if (result := story_cache.get(key)) is None:
+
+        def compute() -> SearchResult:
+            result = SearchResult(search(data, params, lang, deadline, refine_base(key)))
+            story_cache.set(key, result)
+            recent_searches.append(key)
+            return result
+
+        result = search_flight.do(key, compute, deadline)
+
+    if scored and result.scores is None:
+
+        def score() -> dict[int, int]:
+            if result.scores is None:
+                result.scores = relevance(data, params, lang, result.stories, deadline)
+                # 按加入得分后的占用重新计算
+                story_cache.set(key, result)
+            return result.scores
+
+        search_flight.do((*key, "relevance"), score, deadline)
+    return result
 
 
-def format_result(story_seq: str, require: int, lang: support_language, /, extra: Extra | None = None) -> list[Any]:
-    result = []
-    data = story_data[story_seq]
-
-    if require & StoryRequire.ID:
-        result.append(data.id)
-    if require & StoryRequire.TYPE:
-        result.append(data.type)
-    if require & StoryRequire.NAME:
-        result.append(data.name[lang])
-    if require & StoryRequire.CODE:
-        result.append(data.code)
-    if require & StoryRequire.LONG_NAME:
-        result.append(data.long_name[lang])
-    if require & StoryRequire.SHORT_NAME:
-        result.append(data.short_name[lang])
-    if require & StoryRequire.ZONE_ID:
-        result.append(data.zone)
-    if require & StoryRequire.ZONE_NAME:
-        result.append(zone_name[data.zone][lang])
-    if require & StoryRequire.EXTRA and extra:
-        result.append(extra.get(story_seq))
-
+def select_page(req: StoryRequest, result: SearchResult) -> list[int]:
+    """
+    取出当前页的故事id，不对全部结果排序
+    故事id按故事key的顺序分配，即为预先计算的排序名次，按位图升序逐个取出到当前页结束即可
+    按相关度排序时用堆选出前 offset+limit 个
+    """
+    stop = req.offset + req.limit
+    if req.order == "relevance" and (score := result.scores):
+        # nsmallest 对相同的得分保持输入顺序，即故事id升序
+        return heapq.nsmallest(stop, bitmap.iter_ids(result.stories), key=lambda i: -score.get(i, 0))[req.offset :]
+    return list(islice(bitmap.iter_ids(result.stories), req.offset, stop))
+
+
+@cache
+def require_fields(require: int) -> tuple[int, ...]:
+    """require中选中的字段在 Snapshot.story_rows 中的位置"""
+    return tuple(i for i in range(StoryRequire.EXTRA.bit_length() - 1) if require >> i & 1)
+
+
+def format_result(
+    snapshot: Snapshot, story_seq: str, require: int, lang: support_language, /, extra: list[ExtraRow] | None = None
+) -> list[Any]:
+    row = snapshot.story_rows[lang][story_seq]
+    result = [row[i] for i in require_fields(require)]
+    if require & StoryRequire.EXTRA and extra is not None:
+        result.append(extra)
     return result
 
 
-@app.post("/story", tags=["Story"], description="搜索剧情")
-def search_story(req: StoryRequest, limiter=Limiter.depends(**config.limit.rate["story"].param)) -> StoryResponse:
+def json_response(content: bytes) -> Response:
+    """已序列化的结果直接返回，不再经过响应模型的校验"""
+    return Response(content, media_type="application/json")
+
+
+@app.post("/story", tags=["Story"], description="搜索剧情", response_model=StoryResponse)
+async def search_story(
+    req: StoryRequest,
+    deadline: Annotated[Deadline, Depends(get_deadline)],
+    limiter=Limiter.depends(**config.limit.rate["story"].param),
+) -> Response:
     # search.arkfans.top 采用 10q/5s 限频
-    result = sorted(search(req.params))
-    total = len(result)
-    has_more = False
+    data = get_snapshot()
+    return json_response(
+        await pools[req.cost(data)].run(
+            story_flight.do, request_key(data, req), lambda: story_response(data, req, deadline), deadline
+        )
+    )
 
-    if req.offset > len(result):
-        result = []
-    else:
-        result = result[req.offset :]
-        if len(result) > req.limit:
-            result = result[: req.limit]
-            has_more = True
+
+def story_response(data: Snapshot, req: StoryRequest, deadline: Deadline) -> bytes:
+    """结果由引擎生成，无需校验，在工作线程中直接序列化"""
+    found = search_stories(data, req.params, req.lang, deadline, scored=req.order == "relevance")
+    total = bitmap.count(found.stories)
+    has_more = total - req.offset > req.limit
+    result = [data.story_keys[i] for i in select_page(req, found)]
 
     if req.require & StoryRequire.EXTRA:
-        result = [format_result(i, req.require, req.lang, extra=Extra(req.params)) for i in result]
+        extra = Extra(req.params, data, req.lang, deadline).get_many(result)
+        result = [format_result(data, i, req.require, req.lang, extra=extra[i]) for i in result]
     else:
-        result = [format_result(i, req.require, req.lang) for i in result]
+        result = [format_result(data, i, req.require, req.lang) for i in result]
 
     if result and len(result[0]) == 1:
         result = [result[i][0] for i in range(len(result))]
 
-    return StoryResponse(total=total, has_more=has_more, data=result)
+    return orjson.dumps({"total": total, "has_more": has_more, "data": result})
 
 
-@app.get("/story/read", tags=["Story"], description="获取剧情文本")
-def read_story(
+@app.get("/story/read", tags=["Story"], description="获取剧情文本", response_model=tuple[str, str])
+async def read_story(
     id_: str, lang: support_language, limiter=Limiter.depends(**config.limit.rate["read_story"].param)
-) -> tuple[str, str]:
-    if (seq := story_id2story_seq.get(id_)) and (text := text_data[lang].get(seq)):
-        return story_data[seq].name[lang], text
+) -> Response:
+    return json_response(await pools["light"].run(read_text, id_, lang))
+
+
+def read_text(id_: str, lang: support_language) -> bytes:
+    data = get_snapshot()
+    if (seq := data.story_id2story_seq.get(id_)) and (text := data.text_data[lang].get(seq)):
+        return orjson.dumps((data.story_data[seq].name[lang], text))
 
     raise HTTPException(status_code=404)
 
@@ -129,8 +268,33 @@ class MultipleMemoryRequest(BaseModel):
 
 
 @app.post("/story/multiple_memory", tags=["Story"], description="获取干员密录是否有多个，用于转跳PRTS")
-def read_story_multiple_memory(
+async def read_story_multiple_memory(
     req: MultipleMemoryRequest, limiter=Limiter.depends(**config.limit.rate["story_multiple_memory"].param)
 ) -> bool:
     # 支持prts转跳 .e.g 安洁莉娜/干员密录/1-1 & 梅尔/干员密录/1
-    return req.id in multiple_memory
+    return req.id in get_snapshot().multiple_memory
+
+
+@app.get(
+    "/story/suggest",
+    tags=["Story"],
+    description="角色名与所选语言的区域名的补全，返回 [参数类型, 参数, 名称]",
+    response_model=list[tuple[str, str, str]],
+)
+async def suggest_story(
+    prefix: Annotated[str, Query(min_length=1, max_length=20)],
+    lang: support_language = "zh_CN",
+    limit: Annotated[int, Query(ge=1, le=20)] = 10,
+    limiter=Limiter.depends(**config.limit.rate["story_suggest"].param),
+) -> Response:
+    # 二分查找，无需进入工作线程
+    return json_response(orjson.dumps(get_snapshot().suggestions[lang].complete(prefix, limit)))
+
+
+app.on_reload(reload)
+
+
+@app.exception_handler(RegexBudgetError)
+async def regex_budget_handler(request, exc: RegexBudgetError):
+    # 与正则语法错误相同的状态码
+    return JSONResponse(status_code=440, content={"detail": str(exc)})
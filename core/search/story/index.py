@@ -0,0 +1,542 @@
+__all__ = [
+    "GramTextIndex",
+    "LineTable",
+    "NgramIndex",
+    "PhraseIndex",
+    "PrefixIndex",
+    "TextIndex",
+    "TokenIndex",
+    "WordTextIndex",
+    "char_index",
+]
+
+import heapq
+import re
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Collection, Iterable, Mapping, Sequence
+from operator import itemgetter
+
+from . import bitmap
+
+
+class PhraseIndex(ABC):
+    """
+    短语位置索引，所有故事文本以分隔符拼接成一个语料，命中位置由语料位置换算为故事内位置
+    """
+
+    # 语料中的故事id
+    stories: Sequence[int]
+    # 每个故事在语料中的起始位置
+    starts: Sequence[int]
+
+    @abstractmethod
+    def find(self, phrase: str) -> list[int] | None:
+        """
+        短语在语料中的全部起始位置
+        :return: 升序位置，无法由索引判断时返回None
+        """
+
+    def locate(self, position: int) -> tuple[int, int]:
+        """语料位置 -> (故事id, 故事内位置)"""
+        i = bisect_right(self.starts, position) - 1
+        return self.stories[i], position - self.starts[i]
+
+    def contains(self, phrase: str) -> int | None:
+        """包含短语的故事位图，无法由索引判断时返回None"""
+        positions = self.find(phrase)
+        if positions is None:
+            return None
+        return bitmap.from_ids(self.locate(p)[0] for p in positions)
+
+    def search(self, phrase: str) -> dict[int, list[int]] | None:
+        """
+        短语匹配
+        :param phrase: 查询短语
+        :return: {故事id: 故事内的起始位置}，无法由索引判断时返回None
+        """
+        positions = self.find(phrase)
+        if positions is None:
+            return None
+
+        result: dict[int, list[int]] = {}
+        for p in positions:
+            story, local = self.locate(p)
+            if (group := result.get(story)) is None:
+                result[story] = [local]
+            else:
+                group.append(local)
+        return result
+
+
+class NgramIndex(PhraseIndex):
+    """位置n-gram倒排索引
+
+    所有故事文本以分隔符拼接成一个语料，gram -> 该gram在语料中的全部起始位置（升序）
+    """
+
+    # 故事之间的分隔符，包含分隔符的gram不入索引，避免跨故事匹配
+    separator = "\0"
+
+    def __init__(self, texts: dict[str, str], ids: dict[str, int], n: int = 2):
+        self.n: int = n
+        # 语料中的故事id
+        self.stories: Sequence[int] = array("I")
+        # 每个故事在语料中的起始位置
+        self.starts: Sequence[int] = array("I")
+        self.index: dict[str, array] = {}
+
+        offset = 0
+        for story, text in texts.items():
+            self.stories.append(ids[story])
+            self.starts.append(offset)
+            self.add(text, offset)
+            offset += len(text) + len(self.separator)
+
+    def add(self, text: str, offset: int):
+        n = self.n
+        index = self.index
+        for i in range(len(text) - n + 1):
+            gram = text[i : i + n]
+            if (positions := index.get(gram)) is None:
+                positions = index[gram] = array("I")
+            positions.append(offset + i)
+
+    def postings(self, gram: str) -> Sequence[int] | None:
+        """gram在语料中的起始位置"""
+        return self.index.get(gram)
+
+    def plan(self, phrase: str) -> list[tuple[int, str]]:
+        """覆盖短语所需的 (偏移, gram)，末尾不足n的部分用最后一个gram补齐"""
+        n = self.n
+        offsets = list(range(0, len(phrase) - n + 1, n))
+        if offsets[-1] != len(phrase) - n:
+            offsets.append(len(phrase) - n)
+        return [(k, phrase[k : k + n]) for k in offsets]
+
+    def find(self, phrase: str) -> list[int] | None:
+        """
+        短语在语料中的全部起始位置
+        :param phrase: 查询短语
+        :return: 升序位置，短语短于n时无法判断，返回None
+        """
+        if len(phrase) < self.n:
+            return None
+        if self.separator in phrase:
+            return []
+
+        grams = []
+        for k, gram in self.plan(phrase):
+            if (positions := self.postings(gram)) is None:
+                return []
+            grams.append((len(positions), k, positions))
+
+        # 以最稀有的gram为锚点，其余gram按位置二分验证
+        grams.sort(key=itemgetter(0))
+        _, anchor_k, anchor = grams[0]
+        others = grams[1:]
+        result = []
+        for p in anchor:
+            start = p - anchor_k
+            for _, k, positions in others:
+                target = start + k
+                i = bisect_left(positions, target)
+                if i == len(positions) or positions[i] != target:
+                    break
+            else:
+                result.append(start)
+        return result
+
+    def estimate(self, phrase: str) -> int:
+        """查找短语需要逐个验证的位置数，即最稀有的gram的位置数"""
+        if len(phrase) < self.n:
+            return 0
+        return min(len(self.postings(gram) or ()) for _, gram in self.plan(phrase))
+
+
+class TokenIndex(PhraseIndex):
+    """位置词元倒排索引
+
+    文本切分为连续的单词字符与连续的其他字符两种词元，所有故事的词元依次组成一个序列，每个故事后接一个分隔词元
+    词元 -> 该词元在序列中的全部下标（升序）；序列中保存每个词元的id与其在语料中的起始位置
+    短语中间的词元须完整出现，首尾的词元可能是某个词元的一部分，由有序词表查找
+    以位置最少的词元为锚点，其余词元按序列中相邻的词元验证，不需要原文
+    """
+
+    token = re.compile(r"\w+|\W+")
+    # 故事之间的分隔词元，不会出现在短语中
+    separator = "\0"
+    # 只有一个词元且短于此长度的短语，包含它的词元过多，不由索引定位
+    min_length = 3
+
+    def __init__(self, texts: Mapping[str, str], ids: dict[str, int]):
+        runs = {story: self.token.findall(text) for story, text in texts.items()}
+        # 有序词表，词元id即下标，前缀相同的词元id连续
+        self.vocab: Sequence[str] = sorted({w for i in runs.values() for w in i} | {self.separator})
+        vocab_ids = {w: i for i, w in enumerate(self.vocab)}
+        # 序列中各词元的id与在语料中的起始位置
+        self.tokens: Sequence[int] = array("I")
+        self.positions: Sequence[int] = array("I")
+        self.stories: Sequence[int] = array("I")
+        self.starts: Sequence[int] = array("I")
+
+        offset = 0
+        for story, words in runs.items():
+            self.stories.append(ids[story])
+            self.starts.append(offset)
+            for w in words + [self.separator]:
+                self.tokens.append(vocab_ids[w])
+                self.positions.append(offset)
+                offset += len(w)
+
+        # 词元id -> 序列中的下标，即 postings[offsets[id] : offsets[id + 1]]
+        groups = [array("I") for _ in self.vocab]
+        for j, i in enumerate(self.tokens):
+            groups[i].append(j)
+        self.offsets: Sequence[int] = array("Q", [0])
+        self.postings: Sequence[int] = array("I")
+        for group in groups:
+            self.postings.extend(group)
+            self.offsets.append(len(self.postings))
+
+        # 按反转后的词元排序的id，后缀查找同样可以二分
+        self.suffixes: Sequence[int] = array("I", sorted(range(len(self.vocab)), key=lambda i: self.vocab[i][::-1]))
+        # 单字与二字 -> 包含它的词元id，查找包含某段文本的词元时不需要遍历词表
+        self.grams: dict[str, array] = {}
+        for i, w in enumerate(self.vocab):
+            for gram in {w[k : k + n] for n in (1, 2) for k in range(len(w) - n + 1)}:
+                if (group := self.grams.get(gram)) is None:
+                    group = self.grams[gram] = array("I")
+                group.append(i)
+
+    def with_gram(self, gram: str) -> Sequence[int]:
+        """包含单字或二字的词元id"""
+        return self.grams.get(gram, ())
+
+    def id_of(self, token: str) -> int | None:
+        i = bisect_left(self.vocab, token)
+        return i if i < len(self.vocab) and self.vocab[i] == token else None
+
+    def starting_with(self, prefix: str) -> range:
+        lo = bisect_left(self.vocab, prefix)
+        return range(lo, bisect_left(self.vocab, prefix + PrefixIndex.end, lo))
+
+    def ending_with(self, suffix: str) -> Sequence[int]:
+        suffix = suffix[::-1]
+        vocab = self.vocab
+
+        def key(i: int) -> str:
+            return vocab[i][::-1]
+
+        lo = bisect_left(self.suffixes, suffix, key=key)
+        return self.suffixes[lo : bisect_left(self.suffixes, suffix + PrefixIndex.end, lo, key=key)]
+
+    def containing(self, text: str) -> Collection[int]:
+        if len(text) <= 2:
+            return self.with_gram(text)
+        # 以最少的二字为准逐个确认
+        ids = min((self.with_gram(text[k : k + 2]) for k in range(len(text) - 1)), key=len)
+        return [i for i in ids if text in self.vocab[i]]
+
+    def split(self, phrase: str) -> list[str] | None:
+        """短语的各词元，无法由索引定位时返回None"""
+        runs = self.token.findall(phrase)
+        if not runs or (len(runs) == 1 and len(phrase) < self.min_length):
+            return None
+        return runs
+
+    def plan(self, runs: list[str]) -> list[Collection[int]]:
+        """每个词元在序列中可能的词元id：中间的词元须完整出现，首个词元为某个词元的后缀，末个词元为前缀"""
+        if len(runs) == 1:
+            return [self.containing(runs[0])]
+        first, *middle, last = runs
+        exact = [range(i, i + 1) if (i := self.id_of(w)) is not None else range(0) for w in middle]
+        return [self.ending_with(first), *exact, self.starting_with(last)]
+
+    def count(self, ids: Collection[int]) -> int:
+        """词元在序列中的位置总数"""
+        if isinstance(ids, range):
+            return self.offsets[ids.stop] - self.offsets[ids.start] if ids else 0
+        return sum(self.offsets[i + 1] - self.offsets[i] for i in ids)
+
+    def find(self, phrase: str) -> list[int] | None:
+        if (runs := self.split(phrase)) is None:
+            return None
+        if self.separator in phrase:
+            return []
+        candidates = self.plan(runs)
+        if not all(candidates):
+            return []
+
+        anchor = min(range(len(runs)), key=lambda r: self.count(candidates[r]))
+        # range可以直接判断是否包含
+        others = [
+            (r - anchor, ids if isinstance(ids, range) else set(ids)) for r, ids in enumerate(candidates) if r != anchor
+        ]
+        tokens, positions, vocab = self.tokens, self.positions, self.vocab
+        result = []
+        for i in candidates[anchor]:
+            # 短语只有一个词元时可能在词元中多次出现
+            shifts = [k for k in range(len(vocab[i])) if vocab[i].startswith(phrase, k)] if len(runs) == 1 else None
+            for j in self.postings[self.offsets[i] : self.offsets[i + 1]]:
+                if j < anchor or j - anchor + len(runs) > len(tokens):
+                    continue
+                if not all(tokens[j + k] in ids for k, ids in others):
+                    continue
+                if shifts is not None:
+                    result.extend(positions[j] + k for k in shifts)
+                else:
+                    # 首个词元是其所在词元的后缀
+                    first = j - anchor
+                    result.append(positions[first] + len(vocab[tokens[first]]) - len(runs[0]))
+        result.sort()
+        return result
+
+    def estimate(self, phrase: str) -> int:
+        """查找短语需要逐个验证的位置数，即位置最少的词元的位置数"""
+        if (runs := self.split(phrase)) is None:
+            return 0
+        return min(self.count(ids) for ids in self.plan(runs))
+
+
+def char_index(texts: Mapping[str, str], ids: dict[str, int]) -> dict[str, int]:
+    """单字 -> 包含它的故事位图，不含空白字符"""
+    index: dict[str, list[int]] = {}
+    for story, text in texts.items():
+        for c in set(text):
+            if not c.isspace():
+                index.setdefault(c, []).append(ids[story])
+    return {c: bitmap.from_ids(stories) for c, stories in index.items()}
+
+
+class TextIndex(ABC):
+    """某一语言的文本索引"""
+
+    # 该语言的全部故事
+    stories: int
+
+    @abstractmethod
+    def search(self, phrase: str) -> dict[int, list[int] | None]:
+        """
+        短语匹配
+        :return: {故事id: 故事内的起始位置}，位置为None时需要在原文中定位
+        """
+
+    @abstractmethod
+    def contains(self, literal: str) -> int | None:
+        """可能包含字面量的故事位图，无法由索引判断时返回None"""
+
+    @abstractmethod
+    def positional(self, phrase: str) -> bool:
+        """索引能否直接给出命中位置，否则需要在每个候选故事中定位"""
+
+    def estimate(self, phrase: str) -> int:
+        """查找短语时需要逐个处理的位置数，用于与在候选故事中直接定位比较"""
+        return 0
+
+
+class GramTextIndex(TextIndex):
+    """n-gram位置索引，短于n的文本由单字索引给出候选；用于不以空格分词的语言"""
+
+    def __init__(self, ngram: NgramIndex, chars: dict[str, int], stories: int):
+        self.ngram: NgramIndex = ngram
+        self.chars: dict[str, int] = chars
+        # 该语言的全部故事
+        self.stories: int = stories
+
+    def search(self, phrase: str) -> dict[int, list[int] | None]:
+        if (match := self.ngram.search(phrase)) is None:
+            # 单字索引不含空白字符，空白只能在全部故事中定位
+            stories = self.stories if phrase.isspace() else self.chars.get(phrase, 0)
+            return dict.fromkeys(bitmap.to_ids(stories))
+        return match
+
+    def contains(self, literal: str) -> int | None:
+        if (stories := self.ngram.contains(literal)) is not None:
+            return stories
+        if literal.isspace() or not literal:
+            return None
+        return self.chars.get(literal, 0)
+
+    def positional(self, phrase: str) -> bool:
+        return len(phrase) >= self.ngram.n
+
+    def estimate(self, phrase: str) -> int:
+        return self.ngram.estimate(phrase)
+
+
+class WordTextIndex(TextIndex):
+    """
+    词元索引，用于以空格分词的语言
+    短语由词元位置索引直接给出命中位置；只有一个较短词元的短语与正则中的字面量由词 -> 故事位图给出候选
+    """
+
+    word = re.compile(r"\w+")
+
+    def __init__(self, tokens: TokenIndex, words: dict[str, int], stories: int):
+        self.tokens: TokenIndex = tokens
+        # 词 -> 故事位图
+        self.words: dict[str, int] = words
+        self.stories: int = stories
+
+    @classmethod
+    def build(cls, texts: Mapping[str, str], ids: dict[str, int]) -> dict[str, int]:
+        """词 -> 故事位图"""
+        index: dict[str, list[int]] = {}
+        for story, text in texts.items():
+            for w in set(cls.word.findall(text)):
+                index.setdefault(w, []).append(ids[story])
+        return {w: bitmap.from_ids(stories) for w, stories in index.items()}
+
+    def lookup(self, token: str, open_start: bool, open_end: bool) -> int:
+        """
+        包含词的故事位图
+        :param open_start: 词前可能还有字符，即为某个词的后缀
+        :param open_end: 词后可能还有字符，即为某个词的前缀
+        """
+        if open_start and open_end:
+            ids = self.tokens.containing(token)
+        elif open_start:
+            ids = self.tokens.ending_with(token)
+        elif open_end:
+            ids = self.tokens.starting_with(token)
+        else:
+            return self.words.get(token, 0)
+        vocab = self.tokens.vocab
+        result = 0
+        for i in ids:
+            result |= self.words.get(vocab[i], 0)
+        return result
+
+    def contains(self, literal: str) -> int | None:
+        result = None
+        for m in self.word.finditer(literal):
+            stories = self.lookup(m.group(), m.start() == 0, m.end() == len(literal))
+            result = stories if result is None else result & stories
+            if not result:
+                return 0
+        return result
+
+    def search(self, phrase: str) -> dict[int, list[int] | None]:
+        if (match := self.tokens.search(phrase)) is not None:
+            return match
+        if (stories := self.contains(phrase)) is None:
+            # 不含词的短语，如标点
+            stories = self.stories
+        return dict.fromkeys(bitmap.to_ids(stories))
+
+    def positional(self, phrase: str) -> bool:
+        return self.tokens.split(phrase) is not None
+
+    def estimate(self, phrase: str) -> int:
+        return self.tokens.estimate(phrase)
+
+
+class PrefixIndex:
+    """
+    按前缀补全的有序数组，键为大小写折叠后的名称
+    前缀对应的区间由二分得到，区间内按权重从高到低取前N个，相同时按名称
+    区间较大的前缀（如单个字符）预先选出前 limit 个，每次补全最多比较 dense 个条目
+    """
+
+    # 大于任何字符，前缀加上它即为区间的上界
+    end = "\U0010ffff"
+    # 区间超过该大小的前缀预先选出结果
+    dense = 64
+
+    def __init__(self, entries: Iterable[tuple[str, int, tuple]], limit: int = 20):
+        """
+        :param entries: (名称, 权重, 返回值)，名称与返回值相同的只保留一个
+        :param limit: 补全返回的最大数量
+        """
+        items = sorted({(name.casefold(), value): weight for name, weight, value in entries}.items())
+        self.keys: list[str] = [key for (key, _), _ in items]
+        self.values: list[tuple] = [value for (_, value), _ in items]
+        # 按权重从高到低的名次，比较名次即可选出前N个，无需key函数
+        order = sorted(range(len(items)), key=lambda i: -items[i][1])
+        self.ranked: list[tuple] = [self.values[i] for i in order]
+        self.ranks: list[int] = [0] * len(items)
+        for rank, i in enumerate(order):
+            self.ranks[i] = rank
+        self.limit = limit
+        # 前缀 -> 前 limit 个返回值
+        self.top: dict[str, list[tuple]] = {}
+        # 键有序，同一前缀的键相邻，区间较小的前缀之后的键直接跳过
+        small = None
+        for key in self.keys:
+            if small is not None and key.startswith(small):
+                continue
+            for length in range(1, len(key) + 1):
+                prefix = key[:length]
+                if prefix in self.top:
+                    continue
+                lo, hi = self.range(prefix)
+                # 更长的前缀区间只会更小
+                if hi - lo <= self.dense:
+                    small = prefix
+                    break
+                self.top[prefix] = [self.ranked[r] for r in heapq.nsmallest(limit, self.ranks[lo:hi])]
+
+    def range(self, prefix: str) -> tuple[int, int]:
+        lo = bisect_left(self.keys, prefix)
+        return lo, bisect_left(self.keys, prefix + self.end, lo)
+
+    def complete(self, prefix: str, limit: int) -> list[tuple]:
+        prefix = prefix.casefold()
+        if limit <= self.limit and (top := self.top.get(prefix)) is not None:
+            return top[:limit]
+        lo, hi = self.range(prefix)
+        return [self.ranked[r] for r in sorted(self.ranks[lo:hi])[:limit]]
+
+
+class LineTable:
+    """
+    文本的行首位置表，位置 -> 行号由二分完成
+    同时记录每行角色名与台词的分界，即行内最后一个 ": " 的位置
+    """
+
+    __slots__ = ("length", "speakers", "starts")
+
+    length: int
+    starts: Sequence[int]
+    speakers: Sequence[int]
+
+    def __init__(self, text: str):
+        self.length: int = len(text)
+        self.starts: array = array("I", [0])
+        index = text.find("\n")
+        while index != -1:
+            self.starts.append(index + 1)
+            index = text.find("\n", index + 1)
+        # 无角色名的行为-1
+        self.speakers: array = array("i", (text.rfind(": ", self.start(i), self.end(i)) for i in range(len(self))))
+
+    @classmethod
+    def mapped(cls, length: int, starts: Sequence[int], speakers: Sequence[int]) -> "LineTable":
+        """由已构建的位置表创建，不需要原文"""
+        self = cls.__new__(cls)
+        self.length = length
+        self.starts = starts
+        self.speakers = speakers
+        return self
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def line_of(self, position: int) -> int:
+        """位置所在行，换行符属于其结束的行"""
+        return bisect_right(self.starts, position) - 1
+
+    def start(self, line: int) -> int:
+        return self.starts[line]
+
+    def end(self, line: int) -> int:
+        """行尾换行符的位置，最后一行为文本长度"""
+        if line + 1 < len(self.starts):
+            return self.starts[line + 1] - 1
+        return self.length
+
+    def is_dialogue(self, end: int) -> bool:
+        """结束于end的命中不属于角色名，即其后到行尾不再有 ": " 分隔"""
+        return self.speakers[self.line_of(end)] < end
@@ -0,0 +1,181 @@
+__all__ = ["Query", "evaluate", "parse_query"]
+
+import re
+from collections.abc import Callable
+from re import _constants as sre
+from re import _parser as sre_parse
+
+# 查询树：None 匹配全部 | str 必须包含的字面量 | ("and" / "or", [子查询])
+Query = None | str | tuple[str, list["Query"]]
+# 可能匹配到的完整字面量集合，None 表示无法穷举
+Exact = frozenset[str] | None
+
+# 字面量集合的上限，超出后转为查询
+max_exact = 16
+# 正则中需要原样保留的零宽节点
+zero_width = {sre.AT, sre.ASSERT, sre.ASSERT_NOT}
+
+
+def query_and(*queries: Query) -> Query:
+    group = []
+    for q in queries:
+        if q is None:
+            continue
+        if isinstance(q, tuple) and q[0] == "and":
+            group.extend(q[1])
+        else:
+            group.append(q)
+    if not group:
+        return None
+    return group[0] if len(group) == 1 else ("and", group)
+
+
+def query_or(*queries: Query) -> Query:
+    group = []
+    for q in queries:
+        if q is None:
+            return None
+        if isinstance(q, tuple) and q[0] == "or":
+            group.extend(q[1])
+        else:
+            group.append(q)
+    return group[0] if len(group) == 1 else ("or", group)
+
+
+def exact_query(exact: Exact) -> Query:
+    if exact is None or "" in exact:
+        return None
+    return query_or(*sorted(exact))
+
+
+class Info:
+    """正则片段的分析结果"""
+
+    def __init__(self, exact: Exact = None, query: Query = None):
+        self.exact: Exact = exact
+        self.query: Query = query
+
+    @property
+    def required(self) -> Query:
+        return query_and(self.query, exact_query(self.exact))
+
+    @classmethod
+    def alternate(cls, group: list["Info"]) -> "Info":
+        if all(i.exact is not None for i in group):
+            exact = frozenset().union(*(i.exact for i in group))
+            if len(exact) <= max_exact:
+                return cls(exact, query_or(*(i.query for i in group)))
+        return cls(None, query_or(*(i.required for i in group)))
+
+
+EMPTY = Info(frozenset({""}))
+ANY = Info()
+
+
+def analyze_sequence(pattern: sre_parse.SubPattern | list, flags: int) -> Info:
+    query = None
+    # 当前连续的字面量集合
+    exact = EMPTY.exact
+    # 整个序列是否仍可穷举
+    is_exact = True
+    for op, av in pattern:
+        node = analyze_node(op, av, flags)
+        query = query_and(query, node.query)
+        if node.exact is not None and len(exact) * len(node.exact) <= max_exact:
+            exact = frozenset(a + b for a in exact for b in node.exact)
+            continue
+
+        # 无法继续拼接，结算当前字面量，重新开始
+        query = query_and(query, exact_query(exact))
+        exact = node.exact if node.exact is not None else EMPTY.exact
+        is_exact = False
+
+    if is_exact:
+        return Info(exact, query)
+    return Info(None, query_and(query, exact_query(exact)))
+
+
+def analyze_node(op, av, flags: int) -> Info:
+    if op == sre.LITERAL:
+        if flags & re.IGNORECASE:
+            return ANY
+        return Info(frozenset({chr(av)}))
+    if op in zero_width:
+        return EMPTY
+    if op == sre.IN:
+        return analyze_in(av, flags)
+    if op == sre.SUBPATTERN:
+        _, add_flags, del_flags, p = av
+        return analyze_sequence(p, (flags | add_flags) & ~del_flags)
+    if op == sre.ATOMIC_GROUP:
+        return analyze_sequence(av, flags)
+    if op == sre.BRANCH:
+        return Info.alternate([analyze_sequence(p, flags) for p in av[1]])
+    if op in {sre.MAX_REPEAT, sre.MIN_REPEAT, sre.POSSESSIVE_REPEAT}:
+        min_, _, p = av
+        if min_ == 0:
+            return ANY
+        # 至少出现一次，内部的要求依然成立
+        return Info(None, analyze_sequence(p, flags).required)
+    # ANY / NOT_LITERAL / CATEGORY / GROUPREF 等无法提取字面量
+    return ANY
+
+
+def analyze_in(av, flags: int) -> Info:
+    if flags & re.IGNORECASE:
+        return ANY
+    chars = set()
+    for op, value in av:
+        if op == sre.LITERAL:
+            chars.add(chr(value))
+        elif op == sre.RANGE and value[1] - value[0] < max_exact:
+            chars.update(chr(i) for i in range(value[0], value[1] + 1))
+        else:
+            return ANY
+        if len(chars) > max_exact:
+            return ANY
+    return Info(frozenset(chars))
+
+
+def parse_query(pattern: str) -> Query:
+    """
+    提取正则匹配时必须包含的字面量
+    :param pattern: 正则表达式
+    :return: 查询树，None表示无可用字面量
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return None
+    return analyze_sequence(parsed, parsed.state.flags).required
+
+
+def evaluate(query: Query, lookup: Callable[[str], int | None]) -> int | None:
+    """
+    在索引上执行查询
+    :param query: 查询树
+    :param lookup: 字面量 -> 包含它的故事位图，无法判断时返回None
+    :return: 候选故事位图，None表示需要全量扫描
+    """
+    if query is None:
+        return None
+    if isinstance(query, str):
+        return lookup(query)
+
+    op, group = query
+    if op == "and":
+        result = None
+        for q in group:
+            if (stories := evaluate(q, lookup)) is None:
+                continue
+            result = stories if result is None else result & stories
+            if not result:
+                break
+        return result
+
+    result = 0
+    for q in group:
+        if (stories := evaluate(q, lookup)) is None:
+            return None
+        result |= stories
+    return result
@@ -0,0 +1,521 @@
+"""
+正则的安全检查与线性时间匹配
+
+回溯引擎对有歧义的重复可能需要指数/高次多项式的时间，且在C中运行时无法被截止时间打断
+1. 分析正则：无法安全执行的结构直接拒绝
+2. 有歧义、可能大量回溯的正则改由 LinearPattern（Pike VM）匹配，步数不超过 文本长度×程序长度
+3. 其余正则仍使用 re，如以字面量分隔的 .* 与互不相同的字面量分支
+"""
+
+__all__ = ["LinearPattern", "Pattern", "RegexBudgetError", "UnsafeRegexError", "compile_safe", "finditer", "search"]
+
+import re
+from collections.abc import Callable, Iterator
+from functools import reduce
+from re import _constants as sre
+from re import _parser as sre_parse
+
+from core.util import Deadline, unlimited
+
+# 有界重复的次数上限
+max_repeat = 1000
+# 线性引擎程序的指令数上限
+max_program = 5000
+# 含有不以字面量分隔的无界重复，且无界重复达到该数量时视为高次回溯，如 .*\d.*\d.*\d、\w*\w*\w*x
+max_unbounded = 3
+# 以字面量分隔的无界重复超过该数量时视为高次回溯，如 (.*a){12}
+max_chain = 8
+
+unbounded = sre.MAXREPEAT
+repeats = {sre.MAX_REPEAT, sre.MIN_REPEAT, sre.POSSESSIVE_REPEAT}
+
+# 判断两个字符集合是否相交时检查的字符，另加入正则中的字面量与范围端点
+sample_chars = frozenset(map(chr, range(128))) | frozenset("博士あア：\u3000é…\u2028")
+
+CharSet = Callable[[str], bool]
+
+
+class UnsafeRegexError(Exception):
+    """正则无法安全执行"""
+
+
+class RegexBudgetError(Exception):
+    """匹配步数超出上限"""
+
+
+def never(c: str) -> bool:
+    return False
+
+
+def always(c: str) -> bool:
+    return True
+
+
+def union(a: CharSet, b: CharSet) -> CharSet:
+    if a is never:
+        return b
+    if b is never:
+        return a
+    return lambda c: a(c) or b(c)
+
+
+def ignore_case(test: CharSet) -> CharSet:
+    return lambda c: any(test(x) for x in (c, c.lower(), c.upper()) if len(x) == 1)
+
+
+def first(pattern: sre_parse.SubPattern | list, flags: int) -> tuple[CharSet, bool]:
+    """
+    序列可能匹配的第一个字符
+    :return: (字符集合, 是否可以匹配空文本)
+    """
+    result = never
+    for op, av in pattern:
+        chars, nullable = first_of(op, av, flags)
+        result = union(result, chars)
+        if not nullable:
+            return result, False
+    return result, True
+
+
+def first_of(op, av, flags: int) -> tuple[CharSet, bool]:
+    if op == sre.LITERAL:
+        test = chr(av).__eq__
+    elif op == sre.NOT_LITERAL:
+        test = chr(av).__ne__
+    elif op == sre.ANY:
+        test = always if flags & re.DOTALL else lambda x: x != "\n"
+    elif op == sre.IN:
+        test = char_class(av, flags)
+    elif op in repeats:
+        min_, _, p = av
+        chars, nullable = first(p, flags)
+        return chars, nullable or min_ == 0
+    elif op == sre.SUBPATTERN:
+        _, add_flags, del_flags, p = av
+        return first(p, (flags | add_flags) & ~del_flags)
+    elif op == sre.BRANCH:
+        result = [first(p, flags) for p in av[1]]
+        return reduce(union, (chars for chars, _ in result), never), any(nullable for _, nullable in result)
+    elif op == sre.ATOMIC_GROUP:
+        return first(av, flags)
+    elif op in {sre.GROUPREF, sre.GROUPREF_EXISTS}:
+        return always, True
+    else:
+        # 断言与环视不消耗字符
+        return never, True
+    return (ignore_case(test) if flags & re.IGNORECASE else test), False
+
+
+def literal_text(pattern: sre_parse.SubPattern | list, flags: int) -> str | None:
+    """仅由字面量组成的序列的文本"""
+    if flags & re.IGNORECASE or any(op != sre.LITERAL for op, _ in pattern):
+        return None
+    return "".join(chr(av) for _, av in pattern)
+
+
+def sample_of(pattern: sre_parse.SubPattern | list, chars: set[str]):
+    """正则中的字面量与范围端点，用于判断字符集合是否相交"""
+    for op, av in pattern:
+        if op in {sre.LITERAL, sre.NOT_LITERAL}:
+            chars.add(chr(av))
+        elif op == sre.RANGE:
+            chars.update(map(chr, av))
+        elif op == sre.IN:
+            sample_of(av, chars)
+        elif op in repeats:
+            sample_of(av[2], chars)
+        elif op == sre.SUBPATTERN:
+            sample_of(av[3], chars)
+        elif op == sre.BRANCH:
+            for p in av[1]:
+                sample_of(p, chars)
+        elif op in {sre.ASSERT, sre.ASSERT_NOT}:
+            sample_of(av[1], chars)
+        elif op == sre.ATOMIC_GROUP:
+            sample_of(av, chars)
+
+
+class Analysis:
+    """正则中有歧义的结构"""
+
+    def __init__(self, sample: frozenset[str] = sample_chars):
+        self.sample = sample
+        # 重复内的可变长度重复与其后的内容可匹配相同字符，如 (a+)+、(\w+\s?)+
+        self.nested: bool = False
+        # 重复内的分支可匹配相同的文本，如 (a|ab)+、(\d|\w)+
+        self.branch: bool = False
+        # 与之后的字面量可匹配相同字符的无界重复的数量，如 .*罗德岛
+        self.chain: int = 0
+        # 与之后的非字面量可匹配相同字符的无界重复的数量，如 .*\d
+        self.loose: int = 0
+        # 线性引擎不支持的结构
+        self.unsupported: str | None = None
+
+    def overlap(self, a: CharSet, b: CharSet) -> bool:
+        return a is not never and b is not never and any(a(c) and b(c) for c in self.sample)
+
+    def ambiguous(self) -> bool:
+        # 不以字面量分隔的重复之间的回溯与文本长度相乘，以字面量分隔时只与字面量的出现次数相乘
+        return (
+            self.nested
+            or self.branch
+            or self.loose
+            and self.loose + self.chain >= max_unbounded
+            or self.chain > max_chain
+        )
+
+    def ambiguous_branch(self, branches: list, flags: int) -> bool:
+        """互不为前缀的字面量、或首字符互不相同的分支只有一种匹配方式"""
+        texts = [literal_text(p, flags) for p in branches]
+        if all(t is not None for t in texts):
+            return any(i != j and a.startswith(b) for i, a in enumerate(texts) for j, b in enumerate(texts))
+        firsts = [first(p, flags) for p in branches]
+        if any(nullable for _, nullable in firsts):
+            return True
+        return any(self.overlap(a, b) for i, (a, _) in enumerate(firsts) for b, _ in firsts[i + 1 :])
+
+
+def analyze(
+    pattern: sre_parse.SubPattern | list,
+    flags: int,
+    result: Analysis,
+    follow: CharSet = always,
+    separated: bool = False,
+    depth: int = 0,
+):
+    """
+    :param follow: 该序列之后可能出现的字符
+    :param separated: 该序列之后是否为字面量
+    :param depth: 所在的重复层数
+    """
+    items = list(pattern)
+    for i, (op, av) in enumerate(items):
+        rest, nullable = first(items[i + 1 :], flags)
+        after = union(rest, follow) if nullable else rest
+        literal = items[i + 1][0] == sre.LITERAL if i + 1 < len(items) else separated
+        analyze_item(op, av, flags, result, after, literal, depth)
+
+
+def analyze_item(op, av, flags: int, result: Analysis, follow: CharSet, separated: bool, depth: int):
+    if op in repeats:
+        min_, max_, p = av
+        if max_ != unbounded and max_ > max_repeat or min_ > max_repeat:
+            raise UnsafeRegexError(f"repetition count exceeds {max_repeat}")
+        if op == sre.POSSESSIVE_REPEAT:
+            result.unsupported = "possessive repeat"
+        chars, _ = first(p, flags)
+        # 可以继续重复也可以结束，两者可匹配相同字符时需要回溯
+        if max_ != min_ and result.overlap(chars, follow):
+            if depth:
+                result.nested = True
+            if max_ == unbounded and separated:
+                result.chain += 1
+            elif max_ == unbounded:
+                result.loose += 1
+        if max_ == unbounded or max_ > 1:
+            # 重复的内容之后可能是下一次重复
+            before = result.chain, result.loose
+            analyze(p, flags, result, union(chars, follow), False, depth + 1)
+            if max_ != unbounded:
+                # 有界重复内的无界重复按次数展开计数，如 (.*a){12}
+                result.chain += (result.chain - before[0]) * (max_ - 1)
+                result.loose += (result.loose - before[1]) * (max_ - 1)
+        else:
+            analyze(p, flags, result, follow, separated, depth)
+    elif op == sre.BRANCH:
+        if depth and result.ambiguous_branch(av[1], flags):
+            result.branch = True
+        for p in av[1]:
+            analyze(p, flags, result, follow, separated, depth)
+    elif op == sre.SUBPATTERN:
+        _, add_flags, del_flags, p = av
+        analyze(p, (flags | add_flags) & ~del_flags, result, follow, separated, depth)
+    elif op in {sre.ASSERT, sre.ASSERT_NOT}:
+        result.unsupported = "lookaround"
+        analyze(av[1], flags, result, always, False, depth)
+    elif op == sre.ATOMIC_GROUP:
+        result.unsupported = "atomic group"
+        analyze(av, flags, result, follow, separated, depth)
+    elif op in {sre.GROUPREF, sre.GROUPREF_EXISTS}:
+        result.unsupported = "backreference"
+    elif op in {sre.LITERAL, sre.NOT_LITERAL, sre.IN} and flags & re.IGNORECASE:
+        result.unsupported = "ignorecase"
+
+
+# 线性引擎的指令：(操作, 参数...)
+CHAR, SPLIT, JMP, ASSERT, MATCH = range(5)
+
+categories: dict[object, Callable[[str], bool]] = {
+    sre.CATEGORY_DIGIT: str.isdecimal,
+    sre.CATEGORY_NOT_DIGIT: lambda c: not c.isdecimal(),
+    sre.CATEGORY_SPACE: str.isspace,
+    sre.CATEGORY_NOT_SPACE: lambda c: not c.isspace(),
+    sre.CATEGORY_WORD: lambda c: c.isalnum() or c == "_",
+    sre.CATEGORY_NOT_WORD: lambda c: not (c.isalnum() or c == "_"),
+}
+
+
+def is_word(text: str, pos: int) -> bool:
+    return 0 <= pos < len(text) and (text[pos].isalnum() or text[pos] == "_")
+
+
+def assertion(at, flags: int) -> Callable[[str, int], bool]:
+    multiline = flags & re.MULTILINE
+    if at == sre.AT_BEGINNING and multiline or at == sre.AT_BEGINNING_LINE:
+        return lambda text, pos: pos == 0 or text[pos - 1] == "\n"
+    if at in {sre.AT_BEGINNING, sre.AT_BEGINNING_STRING}:
+        return lambda text, pos: pos == 0
+    if at == sre.AT_END and multiline or at == sre.AT_END_LINE:
+        return lambda text, pos: pos == len(text) or text[pos] == "\n"
+    if at == sre.AT_END:
+        return lambda text, pos: pos == len(text) or pos == len(text) - 1 and text[pos] == "\n"
+    if at == sre.AT_END_STRING:
+        return lambda text, pos: pos == len(text)
+    if at == sre.AT_BOUNDARY:
+        return lambda text, pos: is_word(text, pos - 1) != is_word(text, pos)
+    if at == sre.AT_NON_BOUNDARY:
+        return lambda text, pos: is_word(text, pos - 1) == is_word(text, pos)
+    raise UnsafeRegexError(f"unsupported assertion {at}")
+
+
+def char_class(av, flags: int) -> Callable[[str], bool]:
+    negate = False
+    chars = set()
+    tests = []
+    for op, value in av:
+        if op == sre.NEGATE:
+            negate = True
+        elif op == sre.LITERAL:
+            chars.add(chr(value))
+        elif op == sre.RANGE:
+            lo, hi = value
+            tests.append(lambda c, lo=lo, hi=hi: lo <= ord(c) <= hi)
+        elif op == sre.CATEGORY:
+            tests.append(categories[value])
+        else:
+            raise UnsafeRegexError(f"unsupported character set {op}")
+
+    def test(c: str) -> bool:
+        return (c in chars or any(t(c) for t in tests)) != negate
+
+    return test
+
+
+class Compiler:
+    """sre语法树 -> 线性引擎程序"""
+
+    def __init__(self):
+        self.program: list[list] = []
+
+    def emit(self, *instruction) -> int:
+        if len(self.program) >= max_program:
+            raise UnsafeRegexError("pattern is too large")
+        self.program.append(list(instruction))
+        return len(self.program) - 1
+
+    def sequence(self, pattern: sre_parse.SubPattern | list, flags: int):
+        for op, av in pattern:
+            self.node(op, av, flags)
+
+    def node(self, op, av, flags: int):
+        if op == sre.LITERAL:
+            c = chr(av)
+            self.emit(CHAR, lambda x: x == c)
+        elif op == sre.NOT_LITERAL:
+            c = chr(av)
+            self.emit(CHAR, lambda x: x != c)
+        elif op == sre.ANY:
+            self.emit(CHAR, (lambda x: True) if flags & re.DOTALL else (lambda x: x != "\n"))
+        elif op == sre.IN:
+            self.emit(CHAR, char_class(av, flags))
+        elif op == sre.AT:
+            self.emit(ASSERT, assertion(av, flags))
+        elif op == sre.SUBPATTERN:
+            _, add_flags, del_flags, p = av
+            self.sequence(p, (flags | add_flags) & ~del_flags)
+        elif op == sre.BRANCH:
+            self.branch(av[1], flags)
+        elif op in {sre.MAX_REPEAT, sre.MIN_REPEAT}:
+            self.repeat(*av, flags, greedy=op == sre.MAX_REPEAT)
+        else:
+            raise UnsafeRegexError(f"unsupported construct {op}")
+
+    def branch(self, alternatives: list, flags: int):
+        jumps = []
+        for p in alternatives[:-1]:
+            split = self.emit(SPLIT, None, None)
+            self.program[split][1] = len(self.program)
+            self.sequence(p, flags)
+            jumps.append(self.emit(JMP, None))
+            self.program[split][2] = len(self.program)
+        self.sequence(alternatives[-1], flags)
+        for jump in jumps:
+            self.program[jump][1] = len(self.program)
+
+    def repeat(self, min_: int, max_: int, p, flags: int, greedy: bool):
+        for _ in range(min_):
+            self.sequence(p, flags)
+        if max_ == unbounded:
+            # L: split body, end; body; jmp L
+            split = self.emit(SPLIT, None, None)
+            self.sequence(p, flags)
+            self.emit(JMP, split)
+            self.set_split(split, split + 1, len(self.program), greedy)
+            return
+        splits = []
+        for _ in range(max_ - min_):
+            splits.append(self.emit(SPLIT, None, None))
+            self.sequence(p, flags)
+        for split in splits:
+            self.set_split(split, split + 1, len(self.program), greedy)
+
+    def set_split(self, split: int, body: int, end: int, greedy: bool):
+        self.program[split][1:] = [body, end] if greedy else [end, body]
+
+
+class LinearMatch:
+    """与 re.Match 相同的位置接口"""
+
+    __slots__ = ("_end", "_start", "string")
+
+    def __init__(self, string: str, start: int, end: int):
+        self.string: str = string
+        self._start: int = start
+        self._end: int = end
+
+    def start(self) -> int:
+        return self._start
+
+    def end(self) -> int:
+        return self._end
+
+    def span(self) -> tuple[int, int]:
+        return self._start, self._end
+
+    def group(self) -> str:
+        return self.string[self._start : self._end]
+
+
+class LinearPattern:
+    """
+    Pike VM：所有候选状态按优先级同步推进，每个字符每个状态至多处理一次
+    命中位置与 re 相同，为最左、按优先级选择的匹配；不支持捕获组、回溯引用与环视
+    """
+
+    def __init__(self, pattern: str, flags: int = 0):
+        self.pattern: str = pattern
+        self.flags: int = flags
+        parsed = sre_parse.parse(pattern, flags)
+        compiler = Compiler()
+        compiler.sequence(parsed, parsed.state.flags)
+        compiler.emit(MATCH)
+        self.program: list[list] = compiler.program
+
+    def __reduce__(self):
+        # 指令包含闭包，跨进程时重新编译
+        return type(self), (self.pattern, self.flags)
+
+    def add(self, threads: list, seen: set[int], pc: int, start: int, text: str, pos: int):
+        """沿不消耗字符的指令展开，按优先级加入线程"""
+        stack = [pc]
+        while stack:
+            pc = stack.pop()
+            if pc in seen:
+                continue
+            seen.add(pc)
+            instruction = self.program[pc]
+            op = instruction[0]
+            if op == JMP:
+                stack.append(instruction[1])
+            elif op == SPLIT:
+                # 后入先出，优先分支先展开
+                stack.extend((instruction[2], instruction[1]))
+            elif op == ASSERT:
+                if instruction[1](text, pos):
+                    stack.append(pc + 1)
+            else:
+                threads.append((pc, start))
+
+    def search_span(self, text: str, pos: int, deadline: Deadline) -> tuple[int, int] | None:
+        program = self.program
+        steps = 0
+        # 每个位置每条指令至多处理一次
+        max_steps = (len(text) - pos + 1) * len(program)
+        threads: list[tuple[int, int]] = []
+        self.add(threads, set(), 0, pos, text, pos)
+        matched = None
+        while True:
+            steps += len(threads)
+            if steps > max_steps:
+                raise RegexBudgetError(f"pattern exceeds {max_steps} steps")
+            if steps & 0xFFF < len(threads):
+                deadline.check()
+
+            c = text[pos] if pos < len(text) else None
+            following: list[tuple[int, int]] = []
+            seen: set[int] = set()
+            for pc, start in threads:
+                instruction = program[pc]
+                if instruction[0] == MATCH:
+                    # 优先级更低的线程不再需要
+                    matched = (start, pos)
+                    break
+                if c is not None and instruction[1](c):
+                    self.add(following, seen, pc + 1, start, text, pos + 1)
+
+            if c is None:
+                return matched
+            pos += 1
+            if matched is None:
+                # 尚未命中时从下一个位置开始新的尝试，优先级最低
+                self.add(following, seen, 0, pos, text, pos)
+            elif not following:
+                return matched
+            threads = following
+
+    def search(self, text: str, deadline: Deadline = unlimited) -> LinearMatch | None:
+        if (span := self.search_span(text, 0, deadline)) is None:
+            return None
+        return LinearMatch(text, *span)
+
+    def finditer(self, text: str, deadline: Deadline = unlimited) -> Iterator[LinearMatch]:
+        pos = 0
+        while pos <= len(text) and (span := self.search_span(text, pos, deadline)) is not None:
+            yield LinearMatch(text, *span)
+            # 空匹配后前进一个字符，避免重复
+            pos = span[1] if span[1] > span[0] else span[1] + 1
+
+
+Pattern = re.Pattern | LinearPattern
+
+
+def search(pattern: Pattern, text: str, deadline: Deadline = unlimited) -> bool:
+    if isinstance(pattern, LinearPattern):
+        return pattern.search(text, deadline) is not None
+    return pattern.search(text) is not None
+
+
+def finditer(pattern: Pattern, text: str, deadline: Deadline = unlimited) -> Iterator[re.Match | LinearMatch]:
+    if isinstance(pattern, LinearPattern):
+        return pattern.finditer(text, deadline)
+    return pattern.finditer(text)
+
+
+def compile_safe(pattern: str, flags: int = re.MULTILINE) -> Pattern:
+    """
+    检查并编译正则
+    :return: 有歧义、可能大量回溯时为 LinearPattern，否则为 re.Pattern
+    :raise re.error: 语法错误
+    :raise UnsafeRegexError: 无法安全执行
+    """
+    compiled = re.compile(pattern, flags)
+    parsed = sre_parse.parse(pattern, flags)
+    chars = set(sample_chars)
+    sample_of(parsed, chars)
+    result = Analysis(frozenset(chars))
+    analyze(parsed, parsed.state.flags, result)
+    if not result.ambiguous():
+        return compiled
+    if result.unsupported is not None:
+        raise UnsafeRegexError(f"{result.unsupported} is not supported in patterns that may backtrack heavily")
+    return LinearPattern(pattern, flags)
@@ -1,49 +1,148 @@
 import re
-from collections.abc import Callable
+from collections.abc import Callable, Iterator
+from functools import reduce
+from operator import or_
 from typing import Literal
 
 from fastapi import HTTPException
 from pydantic import BaseModel
 
+from core.config import config
 from core.constant import default_lang, support_language
+from core.executor import executor
+from core.util import Deadline, unlimited
+
+from . import bitmap
+from .data import Snapshot, StaleSnapshotError, snapshot_of
+from .index import TextIndex
+from .regex_query import evaluate, parse_query
+from .regex_safety import Pattern, UnsafeRegexError, compile_safe
+from .regex_safety import search as regex_search
+
+# 在一个故事中直接定位文本的耗时，约为索引验证一个位置的倍数
+scan_cost = 4
+
+
+def search_text(
+    data: Snapshot, text: list[str], lang: support_language = default_lang, candidates: int | None = None
+) -> list[dict[int, list[int] | None]]:
+    """
+    文本短语匹配
+    :param text: 文本参数
+    :param candidates: 已知结果所在的故事位图，None为该语言的全部故事；候选较少时直接在原文中定位，比查索引更快
+    :return: 每个文本对应的 {故事id: 命中位置}，位置为None时需要在原文中定位
+    """
+    index = data.text_indexes[lang]
+    scope = index.stories if candidates is None else candidates
+    result = []
+    for t in text:
+        if scan_cheaper(index, t, scope):
+            result.append(dict.fromkeys(bitmap.to_ids(scope)))
+        else:
+            result.append(index.search(t))
+    return result
 
-from .data import char_id2story, char_name2id, char_name2story, text_data, text_index, zone_index
-
-c1 = re.compile(r"\s")
 
+def scan_cheaper(index: TextIndex, text: str, candidates: int) -> bool:
+    """在候选故事中直接定位是否比逐个验证索引中的位置更快，如出现次数很多的常见词"""
+    return bitmap.count(candidates) * scan_cost < index.estimate(text)
+
+
+def relevance(
+    data: Snapshot,
+    params: "StorySearchParamGroup",
+    lang: support_language,
+    stories: int,
+    deadline: Deadline = unlimited,
+) -> dict[int, int]:
+    """
+    按相关度排序的得分：各文本参数在故事台词中的出现次数之和，与 search 相同不计角色名中的出现
+    命中位置由索引给出，位置过多或索引无法给出时在原文中定位
+    :param stories: 搜索结果位图
+    :return: {故事id: 得分}，没有文本参数时为空
+    """
+    text_group = sorted({p.param for p in params if p.type == "text"})
+    if not text_group or not stories:
+        return {}
+    texts = data.text_data[lang]
+    lines = data.line_data[lang]
+    text_match = search_text(data, text_group, lang, stories)
+    score: dict[int, int] = {}
+    for story in deadline.guard(bitmap.to_ids(stories)):
+        key = data.story_keys[story]
+        score[story] = sum(
+            sum(1 for i in match.get(story) or find_all(texts[key], t) if lines[key].is_dialogue(i + len(t)))
+            for t, match in zip(text_group, text_match, strict=True)
+        )
+    return score
+
+
+def find_all(text: str, target: str) -> Iterator[int]:
+    index = text.find(target)
+    while index != -1:
+        yield index
+        index = text.find(target, index + 1)
+
+
+def search_char(
+    data: Snapshot, char: str, lang: support_language = default_lang, deadline: Deadline = unlimited
+) -> int:
+    """角色与区域的位图包含各语言的故事，只保留所选语言中有文本的故事"""
+    return data.char_stories.get(char, 0) & data.text_indexes[lang].stories
+
+
+def search_zone(
+    data: Snapshot, zone: str, lang: support_language = default_lang, deadline: Deadline = unlimited
+) -> int:
+    return data.zone_index.get(zone, 0) & data.text_indexes[lang].stories
+
+
+def compile_regex(regex: str) -> Pattern:
+    try:
+        return compile_safe(regex, flags=re.MULTILINE)
+    except (re.error, UnsafeRegexError) as e:
+        raise HTTPException(440, detail=e.__str__()) from e
 
-def search_text(text: list[str], lang: support_language = default_lang) -> list[set[str]]:
-    return [text_index.get(i, set()) for i in set(c1.sub("", " ".join(text)))]
 
+def prefilter_regex(data: Snapshot, regex: str, lang: support_language = default_lang) -> int | None:
+    """由正则中的字面量得到候选故事位图，None表示需要全量扫描"""
+    return evaluate(parse_query(regex), data.text_indexes[lang].contains)
 
-def search_char(char: str, lang: support_language = default_lang) -> set[str]:
-    result = [char_id2story.get(i, set()) for i in char_name2id(char)] + [char_name2story.get(char, set())]
-    if len(result) > 1:
-        result = result[0].union(*result[1:])
-    elif result:
-        result = result[0]
-    else:
-        result = set()
 
-    return result
+def search_regex(
+    data: Snapshot, reg: Pattern, lang: support_language, deadline: Deadline, candidates: int | None
+) -> int:
+    """
+    正则扫描
+    :param candidates: 限定扫描范围的故事位图，None为全量扫描
+    """
+    stories = [data.story_ids[k] for k in data.text_data[lang]] if candidates is None else bitmap.to_ids(candidates)
+    if executor.enabled(len(stories), config.executor.threshold):
+        try:
+            return reduce(or_, executor.map(scan_shard, stories, data.version, reg, lang, deadline))
+        except StaleSnapshotError:
+            # 子进程已更换为新的快照，在本进程中完成
+            pass
+    return scan_regex(data, stories, reg, lang, deadline)
 
 
-def search_zone(zone: str, lang: support_language = default_lang) -> set[str]:
-    return zone_index.get(zone, set())
+def scan_regex(data: Snapshot, stories: list[int], reg: Pattern, lang: support_language, deadline: Deadline) -> int:
+    texts = data.text_data[lang]
+    return bitmap.from_ids(
+        i
+        for i in deadline.guard(stories)
+        if (text := texts.get(data.story_keys[i])) is not None and regex_search(reg, text, deadline)
+    )
 
 
-def search_regex(regex: str, lang: support_language = default_lang) -> set[str]:
-    try:
-        reg = re.compile(regex, flags=re.MULTILINE)
-    except re.error as e:
-        raise HTTPException(440, detail=e.__str__()) from e
-    return {k for k, text in text_data[lang].items() if reg.search(text)}
+def scan_shard(stories: list[int], version: int, reg: Pattern, lang: support_language, deadline: Deadline) -> int:
+    return scan_regex(snapshot_of(version), stories, reg, lang, deadline)
 
 
-SearchMethod: dict[str, Callable[[str, support_language], set[str]]] = {
+# 只查索引的搜索方法，文本与正则由 search 按代价调度
+SearchMethod: dict[str, Callable[[Snapshot, str, support_language, Deadline], int]] = {
     "char": search_char,
     "zone": search_zone,
-    "regex": search_regex,
 }
 
 
@@ -55,32 +154,77 @@ class StorySearchParam(BaseModel):
 
 StorySearchParamGroup = list[StorySearchParam]
 
-secondary_text_pattern = r"%s(?!: )(?:.(?!: ))*$"
-
 
-def search(params: StorySearchParamGroup) -> set[str]:
+def search(
+    data: Snapshot,
+    params: StorySearchParamGroup,
+    lang: support_language = default_lang,
+    deadline: Deadline = unlimited,
+    within: int | None = None,
+) -> int:
+    """
+    按代价从低到高执行各参数，逐步缩小候选范围，结果为空时提前返回
+    1. zone / char：直接查索引，按结果数量从少到多求交集
+    2. text：所选语言的索引短语匹配，再仅在候选故事的命中位置排除角色名
+    3. regex：字面量预筛选后按候选数量从少到多，仅扫描剩余的候选故事
+    :param within: 已知结果所在的故事位图，如由更宽泛的搜索得到，None为不限定
+    :return: 故事位图
+    """
+    regex_group = [(p.param, compile_regex(p.param)) for p in params if p.type == "regex"]
     text_group = [p.param for p in params if p.type == "text"]
-    result = search_text(text_group) + [SearchMethod[p.type](p.param, default_lang) for p in params if p.type != "text"]
+    # None表示尚未限定范围
+    result: int | None = within
+    if result is not None and not result:
+        return 0
 
-    if len(result) > 1:
-        result = result[0].intersection(*result[1:])
-    elif result:
-        result = result[0]
-    else:
-        result = set()
+    indexed = [SearchMethod[p.type](data, p.param, lang, deadline) for p in params if p.type in SearchMethod]
+    for stories in sorted(indexed, key=bitmap.count):
+        result = stories if result is None else result & stories
+        if not result:
+            return 0
 
     if text_group:
-        for story in result.copy():
-            text = text_data["zh_CN"][story]
-            for t in text_group:
-                i1 = text.find(t)
-                if i1 != -1:
-                    i2 = text.find("\n", i1 + len(t))
-                    i3 = text.find(": ", i1 + len(t), i2)
-                    if i3 == -1 or re.search(secondary_text_pattern % t, text, flags=re.MULTILINE):
-                        # 非角色名称
-                        continue
-                result.remove(story)
-                break
-
-    return result
+        text_match = search_text(data, text_group, lang, result)
+        for match in sorted(text_match, key=len):
+            stories = bitmap.from_ids(match)
+            result = stories if result is None else result & stories
+            if not result:
+                return 0
+
+        # 由各行的角色名分界判断命中是否属于台词，索引未给出位置的文本需要在原文中定位
+        texts = data.text_data[lang]
+        lines = data.line_data[lang]
+
+        def verify(story: int) -> bool:
+            key = data.story_keys[story]
+            return all(
+                any(lines[key].is_dialogue(i + len(t)) for i in match[story] or find_all(texts[key], t))
+                for t, match in zip(text_group, text_match, strict=True)
+            )
+
+        result = bitmap.from_ids(filter(verify, deadline.guard(bitmap.to_ids(result))))
+        if not result:
+            return 0
+
+    if regex_group:
+        plan = []
+        for regex, reg in regex_group:
+            candidates = prefilter_regex(data, regex, lang)
+            if candidates is None:
+                candidates = result
+            elif result is not None:
+                candidates &= result
+            if candidates is not None and not candidates:
+                return 0
+            plan.append((reg, candidates))
+
+        # 全量扫描的排在最后，届时范围已被其他正则缩小
+        plan.sort(key=lambda x: bitmap.count(x[1]) if x[1] is not None else len(data.story_keys))
+        for reg, candidates in plan:
+            if result is not None:
+                candidates = result if candidates is None else candidates & result
+            result = search_regex(data, reg, lang, deadline, candidates)
+            if not result:
+                return 0
+
+    return result or 0
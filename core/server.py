@@ -1,6 +1,11 @@
 import asyncio
+import logging
 import os
+import signal
+from collections.abc import Callable
+from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import TYPE_CHECKING, Any
 
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
@@ -8,35 +13,62 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
 
 from .config import config
+from .executor import executor
 from .rate_limiter import LimiterManager
-from .util import TimeRecorder
+from .supervisor import Supervisor
+from .util import Deadline, TimeRecorder, unlimited
+
+if TYPE_CHECKING:
+    import socket
+
+logger = logging.getLogger("uvicorn.error")
 
 
 class App(FastAPI):
     server: uvicorn.Server | None
     loop: asyncio.AbstractEventLoop | None
+    # 多进程模式下工作进程的主进程pid
+    master: int | None = None
+    # 重新加载数据的函数
+    reloaders: list[Callable[[], Any]] = []
+    # 单进程模式下进行中的数据加载
+    reloading: asyncio.Future | None = None
 
-    async def run(self):
+    async def run(self, sockets: "list[socket.socket] | None" = None):
         self.middleware("http")(self.timeout_handler)
+        self.exception_handler(TimeoutError)(self.deadline_handler)
         self.add_middleware(
             CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"], allow_credentials=True
         )
         self.post("/internal/shutdown", include_in_schema=False)(self.shutdown)
+        self.post("/internal/reload", include_in_schema=False)(self.reload)
         server = uvicorn.Server(uvicorn.Config(app=self, **config.server.params))
         self.server = server
-        await server.serve()
+        await server.serve(sockets)
 
     def start(self):
+        # 搜索子进程只能在服务线程启动前fork，数据更新时需由主进程替换工作进程
+        if config.server.workers > 1 or config.executor.workers > 0:
+            Supervisor(self, config.server.workers).run()
+        else:
+            self.serve()
+
+    def serve(self, sockets: "list[socket.socket] | None" = None):
         try:
             loop = asyncio.get_running_loop()
         except RuntimeError:
             loop = asyncio.new_event_loop()
 
         self.loop = loop
+        executor.start()
         loop.create_task(LimiterManager.scavenger())
-        loop.run_until_complete(self.run())
+        loop.run_until_complete(self.run(sockets))
 
     async def stop(self):
+        if self.master is not None:
+            # 由主进程关闭全部工作进程
+            os.kill(self.master, signal.SIGTERM)
+            return
         # shutdown 不能正常关闭？🤔
         # await self.server.shutdown() 太怪了，不看
         # 强制退出
@@ -44,23 +76,76 @@ class App(FastAPI):
         # 摆烂了，能退出就行👍
 
     async def shutdown(self, req: Request, key: str):
-        if req.client is None or req.client.host != "127.0.0.1" or key != config.key:
-            raise HTTPException(status_code=403)
+        self.check_internal(req, key)
         Path("RESTART").write_bytes(b"RESTART")
         asyncio.create_task(self.stop())
         return {"code": 200}
 
+    async def reload(self, req: Request, key: str):
+        self.check_internal(req, key)
+        if self.master is not None:
+            # 由主进程加载数据并替换工作进程，工作进程继续共享数据
+            os.kill(self.master, signal.SIGHUP)
+            return {"code": 200}
+        if self.reloading is not None and not self.reloading.done():
+            raise HTTPException(status_code=409, detail="reload in progress")
+        # 在后台加载新数据后替换，期间的请求继续使用旧数据
+        self.reloading = asyncio.get_running_loop().run_in_executor(None, self.run_reloaders)
+        self.reloading.add_done_callback(self.reload_done)
+        return {"code": 200}
+
+    @staticmethod
+    def reload_done(future: asyncio.Future):
+        if not future.cancelled() and (exc := future.exception()) is not None:
+            logger.error("reload failed", exc_info=exc)
+
+    def on_reload(self, func: Callable[[], Any]):
+        self.reloaders.append(func)
+        return func
+
+    def run_reloaders(self):
+        for func in self.reloaders:
+            func()
+
+    @staticmethod
+    def check_internal(req: Request, key: str):
+        """内部接口仅允许本机携带key调用"""
+        if req.client is None or req.client.host != "127.0.0.1" or key != config.key:
+            raise HTTPException(status_code=403)
+
     @staticmethod
     async def timeout_handler(request: Request, call_next):
+        # 同步接口运行在线程池中，wait_for无法中断，由搜索过程自行检查截止时间
+        request.state.deadline = Deadline(config.limit.timeout)
         try:
             with TimeRecorder() as t:
                 response = await asyncio.wait_for(call_next(request), config.limit.timeout)
                 response.headers["X-Process-Time"] = str(t.diff)
                 return response
         except TimeoutError:
-            return HTMLResponse(
-                status_code=408, content='{"detail":"Timeout"}', headers={"Content-Type": "application/json"}
-            )
+            return App.timeout_response()
+
+    @staticmethod
+    async def deadline_handler(request: Request, exc: TimeoutError):
+        # 搜索过程检查到截止时间，在接口内直接返回，避免异常抛出中间件
+        return App.timeout_response()
+
+    @staticmethod
+    def timeout_response() -> HTMLResponse:
+        return HTMLResponse(
+            status_code=408, content='{"detail":"Timeout"}', headers={"Content-Type": "application/json"}
+        )
+
+
+def get_deadline(request: Request) -> Deadline:
+    return getattr(request.state, "deadline", unlimited)
+
+
+@asynccontextmanager
+async def lifespan(_: App):
+    yield
+    # uvicorn结束后会重新发出收到的信号使进程直接退出，需在此结束搜索子进程
+    executor.stop()
 
 
-app = App()
+app = App(lifespan=lifespan)
@@ -0,0 +1,54 @@
+__all__ = ["SingleFlight"]
+
+import threading
+from collections.abc import Callable, Hashable
+from typing import Any
+
+from .util import Deadline, unlimited
+
+
+class Call:
+    def __init__(self):
+        self.done: threading.Event = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """相同key的并发调用只执行一次，其余调用等待并共享结果或异常；执行者超时时等待者各自重试"""
+
+    def __init__(self):
+        self.lock: threading.Lock = threading.Lock()
+        self.calls: dict[Hashable, Call] = {}
+
+    def do(self, key: Hashable, func: Callable[[], Any], deadline: Deadline = unlimited) -> Any:
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = Call()
+            if leader:
+                break
+
+            # 等待者按自身的截止时间放弃等待
+            if not call.done.wait(deadline.remaining):
+                raise TimeoutError
+            if isinstance(call.error, TimeoutError):
+                # 执行者按它的截止时间超时，与等待者的截止时间无关，尚有剩余时间时由自己重新执行或等待
+                deadline.check()
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.done.set()
+        return call.result
@@ -0,0 +1,181 @@
+__all__ = ["Supervisor"]
+
+import gc
+import logging
+import os
+import signal
+import time
+import traceback
+from typing import TYPE_CHECKING
+
+import uvicorn
+
+from .config import config
+
+if TYPE_CHECKING:
+    import socket
+
+    from .server import App
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class Supervisor:
+    """
+    预先fork的多进程服务
+    数据在主进程加载并冻结后fork工作进程，工作进程共享监听端口，通过写时复制共享数据，主进程不处理请求
+    SIGHUP：主进程重新加载数据，fork新的工作进程后让旧进程处理完请求退出
+    SIGTERM / SIGINT：关闭全部工作进程后退出
+    工作进程意外退出时延迟补充，启动后很快退出的次数连续超过上限时关闭服务
+    """
+
+    # 等待工作进程退出的时间，超出后强制结束
+    timeout: float = 10
+    # 检查信号与工作进程状态的间隔
+    interval: float = 0.2
+    # 补充工作进程的等待时间，连续启动失败时逐次加倍
+    backoff: float = 0.5
+    backoff_max: float = 30
+    # 运行不足此时间就退出的工作进程视为启动失败
+    stable: float = 10
+    # 连续启动失败的次数上限
+    max_failures: int = 10
+
+    def __init__(self, app: "App", workers: int):
+        self.app: App = app
+        self.workers: int = workers
+        self.socket: socket.socket | None = None
+        # 当前的工作进程，意外退出时补充
+        self.children: set[int] = set()
+        # 数据更新后等待退出的旧工作进程
+        self.retiring: set[int] = set()
+        self.signals: list[int] = []
+        # 工作进程的启动时间
+        self.started: dict[int, float] = {}
+        # 待补充的工作进程的启动时间
+        self.respawns: list[float] = []
+        # 连续启动失败的次数
+        self.failures: int = 0
+
+    def run(self):
+        self.socket = uvicorn.Config(app=self.app, **config.server.params).bind_socket()
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self.handle_signal)
+        self.spawn_all()
+
+        while True:
+            while self.signals:
+                if self.signals.pop(0) == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+                    return
+            self.reap()
+            if self.failures > self.max_failures:
+                logger.error("workers keep exiting during startup, giving up after %d attempts", self.failures)
+                self.stop()
+                return
+            self.respawn()
+            time.sleep(self.interval)
+
+    def handle_signal(self, sig: int, frame):
+        # 信号处理中只记录，由主循环处理
+        self.signals.append(sig)
+
+    def spawn_all(self):
+        # 上一次冻结的对象不会被回收，重新加载后先解冻，回收旧数据后再冻结
+        gc.unfreeze()
+        gc.collect()
+        # 冻结已加载的对象，避免工作进程修改引用计数导致共享页面被复制
+        gc.freeze()
+        self.respawns.clear()
+        self.failures = 0
+        for _ in range(self.workers):
+            self.spawn()
+
+    def spawn(self):
+        if pid := os.fork():
+            self.children.add(pid)
+            self.started[pid] = time.monotonic()
+            return
+
+        # 工作进程
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        code = 0
+        try:
+            self.app.master = os.getppid()
+            self.app.serve([self.socket])
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def reap(self):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.retiring.discard(pid)
+            started = self.started.pop(pid, None)
+            if pid in self.children:
+                # 意外退出的工作进程，启动后很快退出时可能每次都会失败，逐次延长等待
+                self.children.remove(pid)
+                now = time.monotonic()
+                if started is not None and now - started < self.stable:
+                    self.failures += 1
+                    delay = min(self.backoff * 2 ** (self.failures - 1), self.backoff_max)
+                else:
+                    self.failures = 0
+                    delay = 0
+                self.respawns.append(now + delay)
+
+    def respawn(self):
+        now = time.monotonic()
+        due = [i for i in self.respawns if i <= now]
+        self.respawns = [i for i in self.respawns if i > now]
+        for _ in due:
+            self.spawn()
+
+    def reload(self):
+        try:
+            for func in self.app.reloaders:
+                func()
+        except Exception:
+            # 加载失败时保留现有的工作进程
+            traceback.print_exc()
+            return
+
+        old, self.children = self.children, set()
+        self.spawn_all()
+        self.retiring |= old
+        self.kill(old, signal.SIGTERM)
+
+    def stop(self):
+        self.kill(self.children | self.retiring, signal.SIGTERM)
+        end = time.monotonic() + self.timeout
+        while (self.children or self.retiring) and time.monotonic() < end:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(self.interval)
+                continue
+            self.children.discard(pid)
+            self.retiring.discard(pid)
+            self.started.pop(pid, None)
+        self.kill(self.children | self.retiring, signal.SIGKILL)
+
+    @staticmethod
+    def kill(pids: set[int], sig: int):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
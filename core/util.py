@@ -1,4 +1,6 @@
+import math
 import time
+from collections.abc import Iterable, Iterator
 from pathlib import Path
 from timeit import default_timer
 
@@ -80,3 +82,34 @@ class TimeRecorder:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
+
+
+class Deadline:
+    """请求截止时间，供搜索过程协作式检查，超时抛出 TimeoutError"""
+
+    def __init__(self, timeout: float = math.inf):
+        self.end: float = default_timer() + timeout
+
+    @property
+    def expired(self) -> bool:
+        return default_timer() > self.end
+
+    @property
+    def remaining(self) -> float | None:
+        """剩余秒数，不限时为None"""
+        if self.end == math.inf:
+            return None
+        return max(self.end - default_timer(), 0)
+
+    def check(self):
+        if self.expired:
+            raise TimeoutError
+
+    def guard(self, iterable: Iterable) -> Iterator:
+        """迭代时逐项检查是否超时"""
+        for i in iterable:
+            self.check()
+            yield i
+
+
+unlimited = Deadline()
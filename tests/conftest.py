@@ -0,0 +1,17 @@
+import pytest
+
+from core.constant import data_path
+
+# 剧情数据需单独获取，见README；缺少时跳过依赖数据的测试
+story_data = (data_path / "story" / "story_data.json").is_file()
+if not story_data:
+    collect_ignore_glob = ["test_story_*.py"]
+
+
+@pytest.fixture
+def snapshot():
+    if not story_data:
+        pytest.skip("story data not found")
+    from core.search.story.data import get_snapshot
+
+    return get_snapshot()
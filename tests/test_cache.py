@@ -0,0 +1,38 @@
+import sys
+
+from core.cache import LRUCache, sizeof
+
+
+class Slotted:
+    __slots__ = ("items", "value")
+
+    def __init__(self):
+        self.value = 1 << 40000
+
+
+def test_sizeof_counts_slots():
+    obj = Slotted()
+    assert sizeof(obj) >= sys.getsizeof(obj) + sys.getsizeof(obj.value)
+    obj.items = {i: i for i in range(1000)}
+    assert sizeof(obj) >= sys.getsizeof(obj) + sys.getsizeof(obj.value) + sys.getsizeof(obj.items)
+
+
+def test_set_again_recounts_modified_value():
+    cache = LRUCache(1 << 20)
+    value = [0]
+    cache.set("key", value)
+    before = cache.size
+    value.extend(range(1000))
+    cache.set("key", value)
+    assert cache.size > before
+    assert cache.size == sizeof("key") + sizeof(value)
+
+
+def test_oversized_value_replaces_existing_entry():
+    cache = LRUCache(10_000)
+    value = [0]
+    cache.set("key", value)
+    value.extend(range(10_000))
+    cache.set("key", value)
+    assert cache.get("key") is None
+    assert cache.size == 0
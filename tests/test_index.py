@@ -0,0 +1,117 @@
+import random
+import string
+import time
+
+import pytest
+
+from core.search.story.corpus import Corpus
+from core.search.story.index import LineTable, NgramIndex, PrefixIndex, TextIndex, TokenIndex
+
+
+def corpus(seed: int) -> dict[str, str]:
+    rng = random.Random(seed)
+    words = ["".join(rng.choices(string.ascii_letters[:8], k=rng.randint(1, 8))) for _ in range(300)]
+    return {
+        f"story_{i}": "".join(rng.choice(words) + rng.choice([" ", " ", ", ", ": ", ".\n", "'"]) for _ in range(400))
+        for i in range(20)
+    }
+
+
+def brute_force(texts: dict[str, str], separator: str, phrase: str) -> list[int]:
+    joined = separator.join(texts.values())
+    result, i = [], joined.find(phrase)
+    while i != -1:
+        result.append(i)
+        i = joined.find(phrase, i + 1)
+    return result
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_token_index_matches_text(seed):
+    texts = corpus(seed)
+    index = TokenIndex(texts, {k: i for i, k in enumerate(texts)})
+    rng = random.Random(seed)
+    keys = list(texts)
+    for _ in range(300):
+        text = texts[rng.choice(keys)]
+        start = rng.randrange(len(text) - 30)
+        phrase = text[start : start + rng.randint(1, 30)]
+        if (found := index.find(phrase)) is None:
+            assert len(index.token.findall(phrase)) == 1
+            assert len(phrase) < index.min_length
+            continue
+        assert found == brute_force(texts, index.separator, phrase)
+        assert index.estimate(phrase) >= 1
+
+
+def test_token_index_phrases_do_not_span_stories():
+    texts = {"a": "good doctor", "b": "doctor good"}
+    index = TokenIndex(texts, {"a": 0, "b": 1})
+    assert index.search("doctor") == {0: [5], 1: [0]}
+    assert index.find("doctordoctor") == []
+    assert index.find("doctor\0doctor") == []
+    assert index.search("octo") == {0: [6], 1: [1]}
+    assert index.search("od do") == {0: [2]}
+
+
+def test_token_index_finds_words_by_substring():
+    texts = corpus(0)
+    index = TokenIndex(texts, {k: i for i, k in enumerate(texts)})
+    for text in ["ab", "abc", "h", "cde", "zz"]:
+        assert sorted(index.containing(text)) == [i for i, w in enumerate(index.vocab) if text in w]
+
+
+def test_ngram_and_token_index_agree():
+    texts = corpus(1)
+    ids = {k: i for i, k in enumerate(texts)}
+    ngram, tokens = NgramIndex(texts, ids), TokenIndex(texts, ids)
+    for phrase in ["abc", "a, b", ": ab", "ba.\nc"]:
+        assert ngram.search(phrase) == tokens.search(phrase)
+
+
+def test_text_index_is_abstract():
+    with pytest.raises(TypeError):
+        TextIndex()
+
+
+def test_mapped_token_index_matches_built(tmp_path):
+    texts = corpus(2)
+    index = TokenIndex(texts, {k: i for i, k in enumerate(texts)})
+    source = tmp_path / "source.json"
+    source.write_text("{}")
+    lines = {"en_US": {k: LineTable(v) for k, v in texts.items()}}
+    Corpus({"en_US": texts}, lines, {}, {"en_US": index}, {}).dump(tmp_path / "corpus.bin", [str(source)])
+    mapped = Corpus.open(tmp_path / "corpus.bin", [str(source)]).tokens["en_US"]
+    for text in ["ab", "abc", "h", "cde"]:
+        assert list(mapped.containing(text)) == list(index.containing(text))
+        assert list(mapped.ending_with(text)) == list(index.ending_with(text))
+    for phrase in ["abc", "a, b", ": ab", "ba.\nc", "cd'e"]:
+        assert mapped.find(phrase) == index.find(phrase)
+
+
+def prefix_entries(seed: int, size: int) -> list[tuple[str, int, tuple]]:
+    rng = random.Random(seed)
+    names = ["".join(rng.choices("abcAB", k=rng.randint(1, 8))) for _ in range(size)]
+    return [(name, rng.randrange(100), ("char", name, name)) for name in names]
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_prefix_index_matches_sorting(seed):
+    entries = prefix_entries(seed, 2000)
+    index = PrefixIndex(entries)
+    weights = {value: weight for _, weight, value in entries}
+    assert index.top
+    for prefix in ["a", "A", "ab", "bA", "abca", "c", "aaaaaaaaa"]:
+        matched = sorted({v for n, _, v in entries if n.casefold().startswith(prefix.casefold())})
+        for limit in [1, 5, 20, 30]:
+            expected = sorted(matched, key=lambda v: (-weights[v], v[1].casefold(), v))[:limit]
+            assert index.complete(prefix, limit) == expected
+
+
+def test_prefix_index_short_prefix_is_bounded():
+    # 单个字符的前缀覆盖约一半条目，补全耗时不随条目数增长
+    index = PrefixIndex(prefix_entries(0, 200_000))
+    start = time.perf_counter()
+    for _ in range(1000):
+        index.complete("a", 20)
+    assert (time.perf_counter() - start) / 1000 < 1e-3
@@ -0,0 +1,136 @@
+import hashlib
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+import pytest
+
+from core.limiter_backend import Backend, LocalClient, MemoryBackend, RedisBackend, RedisClient, SharedBackend
+
+fork = multiprocessing.get_context("fork")
+
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        Backend()
+
+
+def test_shared_counts_across_processes():
+    backend = SharedBackend(64)
+    child = fork.Process(target=lambda: [backend.apply("story", "ip", 60, 3) for _ in range(2)])
+    child.start()
+    child.join()
+    assert backend.apply("story", "ip", 60, 3)
+    assert not backend.apply("story", "ip", 60, 3)
+    assert backend.apply("story", "other", 60, 3)
+
+
+def test_shared_fails_open_when_lock_holder_is_killed():
+    backend = SharedBackend(64, timeout=0.05)
+    locked = fork.Event()
+
+    def hold():
+        backend.lock.acquire()
+        locked.set()
+        time.sleep(60)
+
+    child = fork.Process(target=hold)
+    child.start()
+    locked.wait()
+    os.kill(child.pid, signal.SIGKILL)
+    child.join()
+    start = time.monotonic()
+    assert all(backend.apply("story", "ip", 60, 1) for _ in range(3))
+    assert time.monotonic() - start < 1
+
+
+def test_local_client_matches_window():
+    backend = RedisBackend(LocalClient())
+    assert [backend.apply("story", "ip", 60, 2) for _ in range(3)] == [True, True, False]
+    assert backend.apply("story", "other", 60, 2)
+
+
+class FakeRedis:
+    """只实现EVAL / EVALSHA的RESP服务，记录收到的命令"""
+
+    def __init__(self):
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port: int = self.server.getsockname()[1]
+        self.commands: list[list[str]] = []
+        self.scripts: set[str] = set()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            conn, _ = self.server.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn: socket.socket):
+        file = conn.makefile("rb")
+        while line := file.readline():
+            args = []
+            for _ in range(int(line[1:-2])):
+                size = int(file.readline()[1:-2])
+                args.append(file.read(size + 2)[:-2].decode())
+            self.commands.append(args)
+            if args[0] == "EVALSHA" and args[1] not in self.scripts:
+                conn.sendall(b"-NOSCRIPT No matching script\r\n")
+            else:
+                if args[0] == "EVAL":
+                    self.scripts.add(hashlib.sha1(args[1].encode()).hexdigest())
+                conn.sendall(b":1\r\n")
+
+
+def test_redis_loads_script_once():
+    redis = FakeRedis()
+    backend = RedisBackend(RedisClient("127.0.0.1", redis.port, 1), "test")
+    assert backend.apply("story", "ip", 1, 5)
+    assert backend.apply("story", "ip", 1, 5)
+    assert [i[0] for i in redis.commands] == ["EVALSHA", "EVAL", "EVALSHA"]
+    assert redis.commands[-1][3:] == ["test:story:ip", "1", "5"]
+
+
+def test_redis_reads_replies():
+    client = RedisClient("127.0.0.1", 0, 1)
+    reply = b"*3\r\n$5\r\nhello\r\n$-1\r\n:42\r\n"
+    reader, writer = socket.socketpair()
+    writer.sendall(reply)
+    assert client.read(reader.makefile("rb")) == ["hello", None, 42]
+
+
+def test_redis_fails_open_when_unreachable():
+    with socket.socket() as unused:
+        unused.bind(("127.0.0.1", 0))
+        port = unused.getsockname()[1]
+    backend = RedisBackend(RedisClient("127.0.0.1", port, 0.05))
+    assert backend.apply("story", "ip", 60, 0)
+
+
+def test_memory_evicts_by_current_expiry(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("core.limiter_backend.time.monotonic", lambda: now[0])
+    backend = MemoryBackend(2)
+
+    def at(t: float, key: str) -> bool:
+        now[0] = t
+        return backend.apply("story", key, 10, 3)
+
+    # 首次请求时加入时间轮，之后的请求使过期时间延后
+    assert at(0, "abuser")
+    assert at(15, "a")
+    assert all(at(25, "abuser") for _ in range(3))
+    assert not at(25, "abuser")
+    # 达到上限时淘汰的是实际最早过期的key，仍在计数的key不被重置
+    assert at(26, "b")
+    assert not at(26, "abuser")
+    assert ("story", "a") not in backend.data
+
+
+def test_memory_capacity_is_bounded():
+    backend = MemoryBackend(8)
+    for i in range(100):
+        backend.apply("story", i, 3600, 5)
+    assert len(backend.data) == 8
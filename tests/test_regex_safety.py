@@ -0,0 +1,85 @@
+import re
+import time
+
+import pytest
+
+from core.search.story.regex_safety import LinearPattern, RegexBudgetError, UnsafeRegexError, compile_safe
+from core.util import Deadline
+
+patterns = [r"(a+)+$", r"(.*)*x", r"(博士|罗德岛)+", r"a.*?b", r"^ab", r"b$", r"\bfoo\b", r"(ab|a)(c|bcd)", r"x{2,4}"]
+texts = ["aaaaab", "xaaxxbx", "博士罗德岛博士 你", "acb ab aab", "foo bar\nfoo", "abcd abc", "xxxxxx xx x", ""]
+
+
+@pytest.mark.parametrize("pattern", patterns)
+def test_linear_matches_re(pattern):
+    linear, reference = LinearPattern(pattern, re.MULTILINE), re.compile(pattern, re.MULTILINE)
+    for text in texts:
+        assert [m.span() for m in linear.finditer(text)] == [m.span() for m in reference.finditer(text)]
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [r"(a+)+$", r"(.*a){12}", r"(.*)*x", r"(\w+\s?)+$", r"(a|ab)+c", r"(a.*b)+c", r".*\d.*\d.*\d", r"\w*\w*\w*x"],
+)
+def test_ambiguous_patterns_use_linear_engine(pattern):
+    assert isinstance(compile_safe(pattern), LinearPattern)
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        r"博士.*罗德岛",
+        r"博士.*罗德岛.*天灾.*龙门",
+        r"(?s)博士.*罗德岛.*天灾.*龙门",
+        r"(罗德岛|龙门)+感染者",
+        r"(a+b)+c",
+        r"(\w+ )+x",
+        r"(?:\d+,){3}\d+",
+        r"^(陈|煌): .*",
+    ],
+)
+def test_unambiguous_patterns_use_re(pattern):
+    assert isinstance(compile_safe(pattern), re.Pattern)
+
+
+def test_unsupported_ambiguous_pattern_is_rejected():
+    with pytest.raises(UnsafeRegexError):
+        compile_safe(r"(a+)+\1")
+
+
+def test_step_budget_scales_with_text():
+    # 步数与文本长度成正比，长文本不因固定的步数上限被拒绝
+    assert compile_safe(r"(a+)+$").search("a" * 50000 + "b") is None
+    assert compile_safe(r"(?s)(a|ab)+c").search("ab" * 25000 + "c") is not None
+
+
+def test_deadline_interrupts_linear_matching():
+    pattern = compile_safe(r"(\w+)+x")
+    deadline = Deadline(0.05)
+    start = time.monotonic()
+    with pytest.raises((TimeoutError, RegexBudgetError)):
+        pattern.search("a" * 20000, deadline)
+    assert time.monotonic() - start < 1
+
+
+def test_scan_passes_request_deadline(monkeypatch, snapshot):
+    from core.search.story.search import scan_regex
+
+    seen = []
+    monkeypatch.setattr(LinearPattern, "search", lambda self, text, deadline=None: seen.append(deadline))
+    deadline = Deadline(10)
+    scan_regex(snapshot, [0], compile_safe(r"(a+)+$"), "zh_CN", deadline)
+    assert seen == [deadline]
+
+
+def test_common_patterns_finish_within_deadline(snapshot):
+    from core.search.story import bitmap
+    from core.search.story.search import StorySearchParam, search
+
+    for pattern in [r"博士.*罗德岛.*天灾.*龙门", r"(罗德岛|龙门)+感染者", r"(?s)博士.*罗德岛.*天灾.*龙门"]:
+        expected = bitmap.from_ids(
+            snapshot.story_ids[k]
+            for k, text in snapshot.text_data["zh_CN"].items()
+            if re.search(pattern, text, re.MULTILINE)
+        )
+        assert search(snapshot, [StorySearchParam(type="regex", param=pattern)], "zh_CN", Deadline(0.5)) == expected
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+
+from core.single_flight import SingleFlight
+from core.util import Deadline
+
+
+def test_waiters_share_result():
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def func():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return 42
+
+    leader = threading.Thread(target=flight.do, args=("k", func))
+    leader.start()
+    started.wait()
+    assert flight.do("k", func) == 42
+    leader.join()
+    assert len(calls) == 1
+
+
+def test_waiter_retries_after_leader_timeout():
+    flight = SingleFlight()
+    started = threading.Event()
+    errors = []
+
+    def slow(deadline: Deadline):
+        started.set()
+        for _ in range(20):
+            deadline.check()
+            time.sleep(0.01)
+        return "done"
+
+    def leader():
+        deadline = Deadline(0.05)
+        try:
+            flight.do("k", lambda: slow(deadline), deadline)
+        except TimeoutError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    started.wait()
+    deadline = Deadline(5)
+    assert flight.do("k", lambda: slow(deadline), deadline) == "done"
+    thread.join()
+    assert len(errors) == 1
+
+
+def test_waiter_shares_other_errors():
+    flight = SingleFlight()
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        time.sleep(0.05)
+        raise ValueError("leader failed")
+
+    thread = threading.Thread(target=lambda: pytest.raises(ValueError, flight.do, "k", fail))
+    thread.start()
+    started.wait()
+    with pytest.raises(ValueError, match="leader failed"):
+        flight.do("k", lambda: 1)
+    thread.join()
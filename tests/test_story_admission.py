@@ -0,0 +1,73 @@
+import asyncio
+import threading
+
+import orjson
+import pytest
+from fastapi import HTTPException
+
+from core.admission import Pool
+from core.config import AdmissionPool
+from core.search.story import http
+from core.search.story.search import StorySearchParam, scan_cheaper
+from core.util import Deadline
+
+
+def request(*params: tuple[str, str], lang: str = "zh_CN") -> http.StoryRequest:
+    return http.StoryRequest(params=[StorySearchParam(type=t, param=p) for t, p in params], lang=lang)
+
+
+def test_cost_classifier(snapshot):
+    assert request(("char", "阿米娅")).cost(snapshot) == "light"
+    assert request(("zone", "main_1"), ("text", "罗德岛天灾")).cost(snapshot) == "light"
+    assert request(("char", "阿米娅"), ("regex", "罗德岛")).cost(snapshot) == "heavy"
+    # 短于索引最小长度的英文文本无法由索引给出位置
+    assert request(("text", "do"), lang="en_US").cost(snapshot) == "heavy"
+    # 常见词逐个验证位置比直接扫描更慢
+    index = snapshot.text_indexes["zh_CN"]
+    assert scan_cheaper(index, "博士", index.stories)
+    assert request(("text", "博士")).cost(snapshot) == "heavy"
+
+
+@pytest.fixture
+def small_pools(monkeypatch):
+    monkeypatch.setitem(http.pools, "light", Pool("light", AdmissionPool(None, 2, 2)))
+    monkeypatch.setitem(http.pools, "heavy", Pool("heavy", AdmissionPool({"retry_after": 3}, 1, 1)))
+    release = threading.Event()
+    story_response = http.story_response
+
+    def blocking(data, req, deadline):
+        # 正则请求占用线程直到测试结束
+        if any(p.type == "regex" for p in req.params):
+            release.wait(10)
+        return story_response(data, req, deadline)
+
+    monkeypatch.setattr(http, "story_response", blocking)
+    yield release
+    release.set()
+
+
+def test_heavy_requests_are_shed_while_light_requests_run(snapshot, small_pools):
+    heavy = http.pools["heavy"]
+
+    def story(*params: tuple[str, str]):
+        return http.search_story(request(*params), Deadline(10), limiter=None)
+
+    async def main():
+        # 占满执行的线程与排队，参数不同以免被合并
+        running = [asyncio.create_task(story(("regex", f"罗德岛{i}"))) for i in range(2)]
+        while not heavy.full:  # noqa: ASYNC110 排队的状态只能轮询
+            await asyncio.sleep(0.01)
+
+        with pytest.raises(HTTPException) as shed:
+            await story(("regex", "龙门"))
+        assert shed.value.status_code == 503
+        assert shed.value.headers == {"Retry-After": "3"}
+
+        light = await story(("char", "阿米娅"))
+        assert orjson.loads(light.body)["total"]
+
+        small_pools.set()
+        for response in await asyncio.gather(*running):
+            assert orjson.loads(response.body)["total"] is not None
+
+    asyncio.run(asyncio.wait_for(main(), 30))
@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+from core.cache import sizeof
+from core.search.story import bitmap, http
+from core.search.story.data import get_snapshot
+from core.search.story.search import StorySearchParam, find_all, search
+from core.util import Deadline
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    http.story_cache.clear()
+    http.recent_searches.clear()
+    yield
+    http.story_cache.clear()
+    http.recent_searches.clear()
+
+
+def text(*params: str) -> list[StorySearchParam]:
+    return [StorySearchParam(type="text", param=i) for i in params]
+
+
+def test_empty_text_is_not_a_base():
+    data = get_snapshot()
+    assert http.search_stories(data, text(""), "zh_CN", Deadline()).stories == search(data, text(""), "zh_CN")
+    assert http.search_stories(data, text("博士"), "zh_CN", Deadline()).stories == search(data, text("博士"), "zh_CN")
+
+
+def test_refines():
+    assert http.refines((("text", "博士们"),), (("text", "博士"),))
+    assert http.refines((("text", "博士"), ("zone", "main_1")), (("text", "博士"),))
+    assert not http.refines((("text", "博士"),), (("text", ""),))
+    assert not http.refines((("text", "博士:"),), (("text", "博士"),))
+    assert not http.refines((("text", "博士"),), (("text", "博士"), ("zone", "main_1")))
+
+
+@pytest.mark.parametrize("lang", ["zh_CN", "ja_JP", "en_US"])
+def test_typing_matches_fresh_search(lang):
+    data = get_snapshot()
+    texts = data.text_data[lang]
+    keys = list(texts)
+    rng = random.Random(lang)
+    for _ in range(20):
+        story = texts[rng.choice(keys)]
+        start = rng.randrange(len(story) - 20)
+        phrase = story[start : start + rng.randint(2, 10)]
+        for end in range(len(phrase) + 1):
+            params = text(phrase[:end])
+            assert http.search_stories(data, params, lang, Deadline()).stories == search(data, params, lang)
+
+
+def test_relevance_counts_dialogue_only():
+    data = get_snapshot()
+    texts, lines = data.text_data["en_US"], data.line_data["en_US"]
+    found = http.search_stories(data, text("en"), "en_US", Deadline(), scored=True)
+    excluded = 0
+    for story in bitmap.to_ids(found.stories):
+        key = data.story_keys[story]
+        positions = list(find_all(texts[key], "en"))
+        assert found.scores[story] == sum(lines[key].is_dialogue(i + 2) for i in positions)
+        excluded += len(positions) - found.scores[story]
+    # 角色名 Ch'en 中的出现不计分
+    assert excluded
+
+
+def test_relevance_is_computed_once(monkeypatch):
+    calls = []
+    monkeypatch.setattr(http, "relevance", lambda *args: calls.append(args) or {})
+    data = get_snapshot()
+    for offset in range(3):
+        req = http.StoryRequest(params=text("博士"), lang="zh_CN", order="relevance", offset=offset)
+        http.story_response(data, req, Deadline())
+    assert len(calls) == 1
+
+
+def test_scores_are_counted_in_cache_size():
+    data = get_snapshot()
+    found = http.search_stories(data, text("博士"), "zh_CN", Deadline())
+    before = http.story_cache.size
+    http.search_stories(data, text("博士"), "zh_CN", Deadline(), scored=True)
+    assert found.scores
+    assert http.story_cache.size == sizeof(http.cache_key(data, text("博士"), "zh_CN")) + sizeof(found)
+    assert http.story_cache.size - before == sizeof(found.scores) - sizeof(None)
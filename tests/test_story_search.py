@@ -0,0 +1,41 @@
+import copy
+
+import orjson
+import pytest
+
+from core.search.story import bitmap, http
+from core.search.story.search import StorySearchParam
+from core.util import Deadline
+
+
+@pytest.fixture
+def missing_en(snapshot):
+    """第一个故事没有英文文本的快照"""
+    data = copy.copy(snapshot)
+    # 与正常快照的缓存区分
+    data.version = -1
+    story = data.story_keys[0]
+    texts = dict(data.text_data["en_US"])
+    del texts[story]
+    data.text_data = {**data.text_data, "en_US": texts}
+    index = copy.copy(data.text_indexes["en_US"])
+    index.stories &= ~bitmap.from_ids([data.story_ids[story]])
+    data.text_indexes = {**data.text_indexes, "en_US": index}
+    yield data, story
+    http.story_cache.clear()
+    http.recent_searches.clear()
+
+
+@pytest.mark.parametrize("type_", ["char", "zone"])
+def test_story_without_text_in_lang_is_skipped(missing_en, type_):
+    data, story = missing_en
+    if type_ == "char":
+        param = next(k for k, v in data.char_stories.items() if v >> data.story_ids[story] & 1)
+    else:
+        param = data.story_data[story].zone
+    req = http.StoryRequest(
+        params=[StorySearchParam(type=type_, param=param)], lang="en_US", require=http.StoryRequire.EXTRA | 1
+    )
+    result = orjson.loads(http.story_response(data, req, Deadline()))
+    assert result["total"]
+    assert data.story_data[story].id not in [i[0] for i in result["data"]]
@@ -0,0 +1,20 @@
+from core.search.story.data import get_snapshot
+
+
+def test_zone_names_follow_language():
+    data = get_snapshot()
+    for lang, index in data.suggestions.items():
+        names = {names[lang] for names in data.zone_name.values() if lang in names}
+        zones = [v for v in index.values if v[0] == "zone"]
+        assert zones
+        assert all(name in names for _, _, name in zones)
+        assert {v for v in index.values if v[0] == "char"} == {
+            ("char", name, name) for name, stories in data.char_stories.items() if stories
+        }
+
+
+def test_zone_completion_by_language():
+    data = get_snapshot()
+    assert all(v[2].startswith("Episode") for v in data.suggestions["en_US"].complete("ep", 20))
+    assert data.suggestions["zh_CN"].complete("ep", 20) == []
+    assert all(v[2].startswith("第") for v in data.suggestions["zh_CN"].complete("第", 20))
@@ -0,0 +1,53 @@
+import gc
+import time
+import weakref
+
+from core.supervisor import Supervisor
+
+
+class CrashingApp:
+    """启动时即退出的工作进程"""
+
+    master = None
+
+    def serve(self, sockets):
+        raise RuntimeError("startup failed")
+
+
+class Data:
+    """冻结后只能由循环回收的对象"""
+
+
+def test_crashing_workers_back_off_and_give_up(capfd):
+    supervisor = Supervisor(CrashingApp(), 1)
+    supervisor.backoff = 0.05
+    supervisor.max_failures = 3
+    supervisor.spawn_all()
+    delays = []
+    end = time.monotonic() + 10
+    while supervisor.failures <= supervisor.max_failures and time.monotonic() < end:
+        supervisor.reap()
+        if supervisor.respawns and len(delays) < supervisor.failures:
+            delays.append(supervisor.respawns[0] - time.monotonic())
+        supervisor.respawn()
+        time.sleep(0.01)
+    supervisor.stop()
+    assert supervisor.failures == supervisor.max_failures + 1
+    assert len(delays) == supervisor.failures
+    # 每次等待约为上一次的两倍
+    assert all(b > a * 1.5 for a, b in zip(delays, delays[1:], strict=False))
+    assert "startup failed" in capfd.readouterr().err
+
+
+def test_reload_collects_frozen_data():
+    supervisor = Supervisor(CrashingApp(), 0)
+    data = Data()
+    data.cycle = data
+    ref = weakref.ref(data)
+    supervisor.spawn_all()
+    del data
+    gc.collect()
+    assert ref() is not None
+    supervisor.spawn_all()
+    assert ref() is None
+    gc.unfreeze()